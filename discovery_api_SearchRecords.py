@@ -6,23 +6,84 @@
 # http://discovery.nationalarchives.gov.uk/API/search/v1/records?sps.recordSeries=ADM%20159&sps.recordSeries=ADM%20188&sps.recordSeries=ADM%20337&sps.recordSeries=ADM%20339&sps.recordSeries=ADM%20362&sps.recordSeries=ADM%20363&sps.recordCollections=Records&sps.recordCollections=DigitisedRecords&sps.catalogueLevels=Level7&sps.lastName=Lomas&sps.number=JX%20125079&sps.searchQuery=*
 # http://discovery.nationalarchives.gov.uk/API/search/v1/records?sps.recordSeries=SC%208&sps.dateFrom=1360-01-01&sps.dateTo=1380-12-31&sps.catalogueLevels=Level7&sps.searchQuery=*&sps.sortByOption=REFERENCE_ASCENDING&sps.batchStartMark=*
 
-## Python standard libraries used, using Python 3.6.4:
-import copy;
+## Python standard libraries used, needs Python 3.7 or later (eg for starting the extraction worker processes with spawn):
 import pprint;
 import string;
 import csv;
 import pathlib;
 import locale;
+import concurrent.futures;
+import datetime;
+import math;
+import json;
+import hashlib;
+import sqlite3;
+import threading;
+import queue;
+import time;
+import zlib;
+import os;
+import multiprocessing;
+import collections;
+import functools;
+import random;
+import email.utils;
+import contextlib;
+import sys;
+import cProfile;
+import pstats;
+import importlib;
+import argparse;
+try :
+	import resource;         #only available on Unix-like systems, used for reporting peak memory use
+except ImportError :
+	resource=None
+
+class LazyModule :
+	'''Stand-in for a module which isn't actually imported until it's first used, so that the script starts quickly (eg for --help), and modules
+	only needed for some kinds of output (eg the Excel writers) aren't loaded at all unless they're needed'''
+	def __init__(self,name,submodules=()) :
+		self._name=name
+		self._submodules=submodules
+		self._module=None
+	
+	def _load(self) :
+		if self._module is None :
+			module=importlib.import_module(self._name)
+			for submodule in self._submodules :
+				importlib.import_module(self._name+"."+submodule)
+			self._module=module
+		return self._module
+	
+	def __getattr__(self,attr) :
+		return getattr(self._load(),attr)
+	
+	def available(self) :
+		'''Check whether the module can be imported (for optional modules)'''
+		try :
+			self._load()
+		except ImportError :
+			return False
+		return True
+
 ## Additional modules required, use pip install to get these from the PyPI - the Python Package Index (https://pypi.python.org/pypi)
-import requests;      #version 2.18.4, used for connecting to the API
-import pandas as pd;  #version 0.22.0, data analysis package, gives us "super spreadsheet" capabilities, everything Excel can do and more
+## All but regex are only imported when first used
 import regex;         #version 2018.2.8, third party regex library, API same as re built-in library, but additional flags and options which are needed
-import pathvalidate;  #version 0.16.3, sanitisation of file/folder names
-import xlsxwriter;    #version 1.0.2, for writing out xlsx files (ie Excel 2003 onwards)
-import xlwt;          #version 1.3.0, for writing out xls files (ie Excel 97 and earlier)
+requests=LazyModule("requests",["adapters"]);   #version 2.18.4, used for connecting to the API
+pd=LazyModule("pandas");                        #version 0.22.0, data analysis package, gives us "super spreadsheet" capabilities, everything Excel can do and more
+pathvalidate=LazyModule("pathvalidate");        #version 0.16.3, sanitisation of file/folder names
+xlsxwriter=LazyModule("xlsxwriter");            #version 1.0.2, for writing out xlsx files (ie Excel 2003 onwards)
+xlwt=LazyModule("xlwt");                        #version 1.3.0, for writing out xls files (ie Excel 97 and earlier)
+## Optional modules, only needed for some kinds of output
+pyarrow=LazyModule("pyarrow",["parquet","ipc"]);  #for writing out Parquet and Feather (Arrow IPC) files
+try :
+	import orjson;           #faster decoding of the JSON returned by the API
+except ImportError :
+	orjson=None
+psutil=LazyModule("psutil");  #used for reporting peak memory use on Windows
 
 ## helper function for making sure a supplied sheet name for Excel worksheet is unique - called recursively up to limit of 3 attempts
-def check_sheet_name_unique(test_sheet_name,call_count=0) :
+def check_sheet_name_unique(test_sheet_name,outpath,excelWriterSheets,call_count=0) :
 	print("entering sheet name checker for",call_count,"th time. Current sheet name",test_sheet_name)
 	if call_count < 3 :
 		print(str(outpath),str(excelWriterSheets))
@@ -39,7 +100,7 @@ def check_sheet_name_unique(test_sheet_name,call_count=0) :
 					print("sheet name has reverted to,",test_sheet_name)
 				## Call the function recursively to check the name we've decided on is unique in the workbook
 				new_sheet_name=test_sheet_name
-				test_sheet_name=check_sheet_name_unique(new_sheet_name,call_count=call_count+1)
+				test_sheet_name=check_sheet_name_unique(new_sheet_name,outpath,excelWriterSheets,call_count=call_count+1)
 				return test_sheet_name;
 			else :
 				print("no entry for sheetname in excelWriterSheets list for current filepath, returning sheet name",test_sheet_name)
@@ -48,9 +109,1517 @@ def check_sheet_name_unique(test_sheet_name,call_count=0) :
 			print("no entry for filepath in excelWriterSheets, returning sheet name",test_sheet_name)
 			return test_sheet_name;
 	else :
-		error_message=f"could not create unique name for worksheet {worksheet}!r in file {outpath}!r within 3 attempts"
+		error_message=f"could not create unique name for worksheet {test_sheet_name!r} in file {outpath!r} within 3 attempts"
 		raise RuntimeError(error_message)
 
+## Default set of fields taken from the Discovery JSON into the output if discovery_columns is not supplied in the input CSV
+default_discovery_columns=["reference","coveringDates","startDate","endDate","numStartDate","numEndDate","description","id","places"]
+
+## The SearchRecords API endpoint, this can be pointed elsewhere (eg at the local stand-in for the API used by discovery_api_SearchRecords_benchmark.py)
+api_url = "http://discovery.nationalarchives.gov.uk/API/search/v1/records"
+
+## Having developed the rest of the script, don't really need the JSON written out, but may be useful for debugging, so keep code
+debug = False
+
+## Maximum number of rows from the input CSV to be run at the same time. Rows writing to the same output file (including APPEND rows) are always
+## run one after another in input order, so this only parallelises rows with different output files. Set to 1 to run everything in sequence.
+max_concurrent_rows = 4
+
+## A search with both sps.dateFrom and sps.dateTo set which returns more than this number of records is split into date ranges ("shards") each
+## expected to hold roughly this many records, and the shards are paged through at the same time, up to max_shard_connections at once.
+## Set date_shard_size to 0 to always page through a search as a single sequence of requests.
+date_shard_size = 10000
+max_shard_connections = 4
+
+## While a search is being paged through, the next pages are fetched by a separate thread, which keeps up to prefetch_pages pages waiting ahead of
+## the one being processed, so that requests to the API carry on while earlier pages go through extraction (and, with stream_output, are written out).
+## Only that many pages are held waiting, so a slow consumer doesn't let memory use grow. Set to 0 to only fetch each page once it's needed.
+prefetch_pages = 2
+
+## Responses from the API are kept in a local SQLite file, so that rerunning an input CSV where only labels, regex, discovery_columns etc have changed
+## doesn't need to download everything again. Responses older than response_cache_ttl seconds are ignored and refetched, and once the cache is bigger than
+## response_cache_max_bytes the least recently used responses are removed. Set response_cache_path to None to turn the cache off. If cache_only is True
+## no requests are made to the API at all, and the script will stop with an error if a response isn't already in the cache.
+response_cache_path = "discovery_api_response_cache.sqlite"
+response_cache_ttl = 24*60*60
+response_cache_max_bytes = 500*1024*1024
+cache_only = False
+
+## Each page retrieved for a row of the input CSV is also saved, along with the nextBatchMark, to a checkpoint file in a folder alongside the output
+## file (named after the output file with .checkpoints on the end). If the script is stopped part way through, rerunning the same input CSV picks
+## up from the last page saved rather than starting again. The checkpoint is deleted once the output for the row has been written.
+checkpoint_downloads = True
+
+## Incremental refresh (turned on by setting incremental_refresh to True, or with --incremental): the records harvested for each row of the input CSV
+## are kept in a local SQLite file (record_store_path), along with the data extracted from their descriptions. When the same search is run again,
+## a search with a date range is split into date ranges of about refresh_segment_size records, and a single record is requested for each to check
+## how many records it now has. Only the date ranges whose count has changed are paged through again, and only records whose description has changed
+## (or which are new) go through extraction again, with the output rebuilt from the store. A search without a date range is fetched again if its
+## count has changed. As a change to a record which doesn't change the count can't be spotted this way, everything is fetched again once the last
+## full harvest is more than refresh_max_age seconds old (set to 0 to never do this). Not used with max_records or stream_output. These requests
+## bypass the response cache (except with cache_only), so that changes to the catalogue aren't hidden by cached responses.
+incremental_refresh = False
+record_store_path = "discovery_api_record_store.sqlite"
+refresh_segment_size = 2000
+refresh_max_age = 28*24*60*60
+
+## Searches answered locally (turned on by setting local_queries to True, or with --local-queries, which also turns on incremental_refresh so that
+## searches are kept in the record store): a row of the input CSV which would only return records already held in the record store for another
+## search, checked against the API within the last local_query_max_age seconds, is answered from the store without making any requests. This is
+## the case when the other search has the same parameters apart from sps.dateFrom/sps.dateTo and sps.recordSeries, and its date range and series
+## include those of the row (or it has none). A record is taken to be within a date range if its covering dates overlap the range, and its series
+## is the part of its reference before the first slash. Results are in reference order, and max_records is applied by whole pages as it is by the API.
+local_queries = False
+local_query_max_age = 24*60*60
+
+## Extracting data from the descriptions is CPU heavy, so for large sets of records the DataFrame is split into chunks of extraction_chunk_size rows
+## which are processed in separate processes, up to extraction_workers at once. Anything under parallel_extraction_threshold rows is processed directly,
+## as the cost of starting worker processes and passing the data to them outweighs the gain. Set extraction_workers to 1 to never use worker processes.
+extraction_workers = os.cpu_count() or 1
+parallel_extraction_threshold = 20000
+extraction_chunk_size = 5000
+
+## Possible labels found in the descriptions which aren't in the labels list are counted across all the rows going to an output file, and
+## the totals written to a CSV file alongside it, named after the output file (including its extension, so that eg out.xlsx and out.parquet
+## each get their own) with _other_possible_labels.csv on the end (if any were found).
+## This is useful for refining the labels list. Set to False to not write the file.
+other_labels_report = True
+
+## At the end of the run a report is written of how long each stage took for each row of the input CSV (requests to the API, decoding the JSON,
+## building the DataFrame, extracting the labelled data, looking for other possible labels and writing the output), the amount of data transferred
+## and the peak memory use, as run_report_path with .json on the end (including the details of every page) and .csv (one line per row of the input CSV).
+## Set run_report_path to None to not write the report. Set profile_run to True to also run Python's profiler over the searches, writing the
+## results to profile_path (which can be read with the pstats module, or tools such as snakeviz) and printing the functions which took longest.
+run_report_path = "discovery_api_run_report"
+profile_run = False
+profile_path = "discovery_api_run_profile.prof"
+
+class ResponseCache :
+	'''On-disk cache of API responses, keyed on the URL and the full set of parameters (including sps.batchStartMark) used for the request'''
+	def __init__(self,path,ttl,max_bytes) :
+		self.ttl=ttl
+		self.max_bytes=max_bytes
+		## The cache is shared by all the threads running searches, so all access to the database goes through the one connection, protected by a lock
+		self.lock=threading.Lock()
+		self.connection=sqlite3.connect(str(path),check_same_thread=False)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, size INTEGER, stored REAL, last_used REAL)")
+		self.connection.commit()
+	
+	@staticmethod
+	def make_key(url,params) :
+		'''Normalise the request into a stable string (empty parameters dropped, keys in sorted order) and hash it'''
+		normalised={key:value for key,value in params.items() if value is not None}
+		return hashlib.sha256(json.dumps([url,normalised],sort_keys=True).encode("utf-8")).hexdigest()
+	
+	def get(self,key) :
+		'''Return the stored response body for the key, or None if there isn't one or it has expired'''
+		now=time.time()
+		with self.lock :
+			found=self.connection.execute("SELECT body, stored FROM responses WHERE key=?",(key,)).fetchone()
+			if not found :
+				return None
+			if self.ttl and now-found[1] > self.ttl :
+				self.connection.execute("DELETE FROM responses WHERE key=?",(key,))
+				self.connection.commit()
+				return None
+			self.connection.execute("UPDATE responses SET last_used=? WHERE key=?",(now,key))
+			self.connection.commit()
+		return zlib.decompress(found[0])
+	
+	def put(self,key,body) :
+		'''Store a response body, then remove least recently used responses until the cache is back within its size limit'''
+		now=time.time()
+		compressed=zlib.compress(body)
+		with self.lock :
+			self.connection.execute("INSERT OR REPLACE INTO responses (key, body, size, stored, last_used) VALUES (?,?,?,?,?)",(key,compressed,len(compressed),now,now))
+			if self.max_bytes :
+				total_size=self.connection.execute("SELECT COALESCE(SUM(size),0) FROM responses").fetchone()[0]
+				if total_size > self.max_bytes :
+					for oldkey, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall() :
+						if total_size <= self.max_bytes :
+							break
+						self.connection.execute("DELETE FROM responses WHERE key=?",(oldkey,))
+						total_size-=size
+			self.connection.commit()
+
+## The cache itself is opened once the script starts running (so not in any worker processes)
+response_cache=None
+
+## All requests to the API go through one shared session, with a pool of up to connection_pool_size connections which are reused across all rows
+## (this needs to be at least max_concurrent_rows times max_shard_connections to avoid connections being thrown away). Each request times out if
+## the connection can't be made in request_timeout[0] seconds, or no data is received for request_timeout[1] seconds. Timeouts, connection errors
+## and responses saying the server is busy or had a temporary problem are retried up to max_retries times, waiting a random time of up to
+## retry_backoff seconds, doubling with each attempt up to retry_backoff_max, or at least as long as the server asks for in a Retry-After header.
+## If the server asks for a wait of more than retry_after_max seconds the run stops with an error rather than waiting that long.
+## Requests are limited to requests_per_second on average, with short bursts of up to request_burst requests allowed.
+connection_pool_size = 16
+request_timeout = (10,120)
+max_retries = 5
+retry_backoff = 2
+retry_backoff_max = 120
+retry_after_max = 60*60
+retry_status_codes = [429,500,502,503,504]
+requests_per_second = 5
+request_burst = 10
+
+class RateLimiter :
+	'''Token bucket rate limiter shared by all threads: tokens are added at rate per second up to capacity, and each request takes one'''
+	def __init__(self,rate,capacity) :
+		self.rate=rate
+		self.capacity=capacity
+		self.tokens=capacity
+		self.updated=time.monotonic()
+		self.lock=threading.Lock()
+	
+	def acquire(self) :
+		'''Wait until a token is available, then take it'''
+		while True :
+			with self.lock :
+				now=time.monotonic()
+				self.tokens=min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+				self.updated=now
+				if self.tokens >= 1 :
+					self.tokens-=1
+					return
+				wait=(1-self.tokens)/self.rate
+			time.sleep(wait)
+
+class DiscoveryTransport :
+	'''Shared HTTP transport for all requests to the API, providing connection pooling, timeouts, retries with backoff and rate limiting'''
+	def __init__(self) :
+		self.session=requests.Session()
+		adapter=requests.adapters.HTTPAdapter(pool_connections=connection_pool_size,pool_maxsize=connection_pool_size)
+		self.session.mount("http://",adapter)
+		self.session.mount("https://",adapter)
+		if requests_per_second :
+			self.rate_limiter=RateLimiter(requests_per_second,request_burst)
+		else :
+			self.rate_limiter=None
+	
+	@staticmethod
+	def get_retry_after(r) :
+		'''Number of seconds the server has asked us to wait in a Retry-After header (given either as seconds or as a date), or None'''
+		retry_after=r.headers.get("Retry-After")
+		if not retry_after :
+			return None
+		if retry_after.strip().isdigit() :
+			return int(retry_after)
+		try :
+			retry_date=email.utils.parsedate_to_datetime(retry_after)
+		except (TypeError,ValueError) :
+			return None
+		return max(0,(retry_date-datetime.datetime.now(retry_date.tzinfo)).total_seconds())
+	
+	@staticmethod
+	def wait_to_retry(attempt,retry_after=None) :
+		'''Wait before retrying a failed request'''
+		## exponential backoff with "full jitter", so that threads which failed at the same time don't all retry at the same time
+		wait=random.uniform(0,min(retry_backoff_max,retry_backoff*2**attempt))
+		if retry_after is not None :
+			if retry_after > retry_after_max :
+				raise RuntimeError(f"The API asked for a wait of {retry_after:.0f} seconds before retrying, which is more than retry_after_max ({retry_after_max} seconds)")
+			wait=max(wait,retry_after)
+		print(f"retrying in {wait:.1f} seconds (attempt {attempt+2} of {max_retries+1})")
+		time.sleep(wait)
+	
+	def get(self,url,headers=None,params=None) :
+		'''Make a GET request, retrying on temporary failures. An exception is raised once retries run out, or for any other error response.'''
+		for attempt in range(max_retries+1) :
+			if self.rate_limiter :
+				self.rate_limiter.acquire()
+			retry_after=None
+			try :
+				r=self.session.get(url,headers=headers,params=params,timeout=request_timeout)
+			except (requests.exceptions.ConnectionError,requests.exceptions.Timeout,
+				requests.exceptions.ChunkedEncodingError,requests.exceptions.ContentDecodingError) as error :
+				## the connection failed or stalled, or the response was cut short or its compression is corrupt
+				if attempt == max_retries :
+					raise
+				print("request failed:",error)
+			else :
+				if r.status_code not in retry_status_codes or attempt == max_retries :
+					## check we have an OK response from the server (ie not a 404 not found etc), an exception will be raised if not
+					r.raise_for_status()
+					return r
+				print("request failed with status",r.status_code)
+				retry_after=self.get_retry_after(r)
+			self.wait_to_retry(attempt,retry_after)
+
+## The shared transport is also created once the script starts running
+transport=None
+
+class PatternRegistry :
+	'''Compiled regexes keyed by their source string and flags, so that rows of the input CSV sharing the same labels or regex (and every page
+	of results) only pay the cost of compiling once. Only the most recently used max_patterns are kept.'''
+	def __init__(self,max_patterns=128) :
+		self.max_patterns=max_patterns
+		self.patterns=collections.OrderedDict()
+		self.lock=threading.Lock()
+	
+	def compile(self,pattern,flags=regex.POSIX|regex.VERSION1) :
+		'''Return the compiled regex for the pattern, compiling it (and reporting how long that took) if it isn't already held'''
+		key=(pattern,flags)
+		with self.lock :
+			if key in self.patterns :
+				self.patterns.move_to_end(key)
+				return self.patterns[key]
+		compile_start=time.perf_counter()
+		compiled=regex.compile(pattern,flags=flags)
+		print(f"compiled regex in {time.perf_counter()-compile_start:.4f} seconds:",pattern)
+		with self.lock :
+			self.patterns[key]=compiled
+			while len(self.patterns) > self.max_patterns :
+				self.patterns.popitem(last=False)
+		return compiled
+
+pattern_registry=PatternRegistry()
+
+## Translation table used to normalise a label into a label_id in one go: punctuation characters are removed, whitespace characters replaced with underscore
+label_id_table=str.maketrans({**{char:None for char in string.punctuation},**{char:"_" for char in string.whitespace}})
+
+@functools.lru_cache(maxsize=1024)
+def normalise_label_id(label) :
+	'''Construct the normalised label_id for a label, to be used as the regex group name and output column name'''
+	## casefold, to lower case as aggressively as possible as defined in Unicode
+	return label.translate(label_id_table).casefold()
+
+@functools.lru_cache(maxsize=128)
+def build_label_pattern(labels) :
+	'''Build the regex for extracting the text following each of a tuple of labels from a description'''
+	## initialise list for the individual regex groups that will be created from the label list
+	descfields_list=[]
+	
+	## Go through the label list for each label in turn, construct a normalised label id, and construct the high level regex group for that label 
+	## and its related text.
+	for label in labels :
+		label_id=normalise_label_id(label)
+		## construct the group for the label and its associated text, make sure any regex metacharacters are escaped to avoid unexpected results.
+		escaped_label=regex.escape(label)
+		relabelgroup=r"("+escaped_label+r":( )?"+r"(?P<"+label_id+r">.*?)(\. |$))?"
+		descfields_list.append(relabelgroup)
+	## Now build the full regex, join the elements of the list into one big string using empty string as the joining character (making each group optional):
+	return "".join(descfields_list)
+
+stats_lock=threading.Lock()
+
+def count_stat(stats,name,amount=1) :
+	'''Add to a counter in the per-row stats dictionary (which may be updated from several threads at once)'''
+	if stats is not None :
+		with stats_lock :
+			stats[name]=stats.get(name,0)+amount
+
+@contextlib.contextmanager
+def time_stat(stats,name) :
+	'''Add the time taken to run the enclosed block to a timer in the per-row stats dictionary'''
+	start=time.perf_counter()
+	try :
+		yield
+	finally :
+		count_stat(stats,name,time.perf_counter()-start)
+
+def merge_stats(stats,other_stats) :
+	'''Add all the counters and timers from another stats dictionary (eg one returned from a worker process) to the per-row stats'''
+	for name, amount in other_stats.items() :
+		count_stat(stats,name,amount)
+
+def get_peak_rss() :
+	'''Return the peak memory use (resident set size) of the script so far in bytes, or None if it can't be found on this system'''
+	if resource :
+		peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		## macOS gives the size in bytes, Linux in kilobytes
+		if sys.platform == "darwin" :
+			return peak_rss
+		return peak_rss*1024
+	if psutil.available() :
+		return getattr(psutil.Process().memory_info(),"peak_wset",None)
+	return None
+
+def decode_page(body,fields=None) :
+	'''Decode the JSON for a page of results (using orjson if it's installed, as it's several times quicker than the built-in json module),
+	keeping only the given fields of each record, so no memory is used holding on to fields which won't be output'''
+	if orjson :
+		rjson=orjson.loads(body)
+	else :
+		rjson=json.loads(body)
+	if fields :
+		rjson["records"]=[{field:record.get(field) for field in fields} for record in rjson["records"]]
+	return rjson
+
+def get_page_json(s,url,headers,params,stats=None,fields=None,page_info=None,use_cache=True) :
+	'''Make one GET request to the API (or find the response in the cache), returning the decoded JSON. If a page_info dictionary is given, it is
+	filled in with the number of bytes transferred over the network (after any compression) and the number of bytes of JSON decoded.
+	If use_cache is False the request always goes to the API (unless cache_only is set), though the response is still stored in the cache.'''
+	if page_info is None :
+		page_info={}
+	if response_cache :
+		key=ResponseCache.make_key(url,params)
+	if response_cache and (use_cache or cache_only) :
+		body=response_cache.get(key)
+		if body is not None :
+			count_stat(stats,"cache_hits")
+			page_info["wire_bytes"]=0
+			page_info["decoded_bytes"]=len(body)
+			count_stat(stats,"decoded_bytes",len(body))
+			start=time.perf_counter()
+			rjson=decode_page(body,fields)
+			page_info["decode_seconds"]=time.perf_counter()-start
+			count_stat(stats,"decode_seconds",page_info["decode_seconds"])
+			return rjson
+		count_stat(stats,"cache_misses")
+	if cache_only :
+		raise RuntimeError(f"cache_only is set but no cached response found for {params!r}")
+	
+	## make the GET request, put the response into variable r.  See http://docs.python-requests.org/en/master/user/quickstart/ for info
+	## s is the shared DiscoveryTransport, which retries temporary failures, and raises an exception for any other error response.
+	## A response which arrives complete but isn't valid JSON (eg cut short by a proxy) is requested again in the same way.
+	for attempt in range(max_retries+1) :
+		start=time.perf_counter()
+		r=s.get(url, headers=headers, params=params);
+		body=r.content
+		page_info["http_seconds"]=time.perf_counter()-start
+		count_stat(stats,"http_seconds",page_info["http_seconds"])
+		
+		## The raw response knows how many bytes actually came over the network, which will be less than the decoded content if it was compressed
+		try :
+			wire_bytes=r.raw.tell()
+		except (AttributeError,TypeError) :
+			wire_bytes=0
+		if not wire_bytes :
+			wire_bytes=int(r.headers.get("Content-Length",len(body)))
+		page_info["wire_bytes"]=wire_bytes
+		page_info["decoded_bytes"]=len(body)
+		count_stat(stats,"wire_bytes",wire_bytes)
+		count_stat(stats,"decoded_bytes",len(body))
+		
+		## decode the JSON returned from the server to give us Python data structures (lists/dicts)
+		start=time.perf_counter()
+		try :
+			rjson=decode_page(body,fields)
+		except ValueError as error :
+			if attempt == max_retries :
+				raise
+			print("response could not be decoded:",error)
+			DiscoveryTransport.wait_to_retry(attempt)
+			continue
+		finally :
+			page_info["decode_seconds"]=time.perf_counter()-start
+			count_stat(stats,"decode_seconds",page_info["decode_seconds"])
+		break
+	if response_cache :
+		response_cache.put(key,body)
+	return rjson
+
+def get_checkpoint_path(search) :
+	'''Work out the checkpoint file for a row of the input CSV, based on the output file, the line number and the parameters used'''
+	paramsHash=hashlib.sha256(json.dumps([search["myparams"],search["max_records"],search["discovery_columns"]],sort_keys=True).encode("utf-8")).hexdigest()[0:16]
+	outpath=search["outpath"]
+	return outpath.parent / (outpath.name+".checkpoints") / f"line{search['rownum']}_{paramsHash}.jsonl"
+
+def read_checkpoint(checkpoint_path) :
+	'''Generator yielding the pages saved in a checkpoint file by an earlier run, one JSON object per line'''
+	if not checkpoint_path.exists() :
+		return
+	## if the earlier run was stopped while writing a page, the last line will be incomplete, so cut the file back to the last complete line
+	with open(checkpoint_path,mode="rb+") as checkpointin :
+		content_length=checkpointin.seek(0,2)
+		checkpointin.seek(0)
+		good_length=checkpointin.read().rfind(b"\n")+1
+		if good_length < content_length :
+			checkpointin.truncate(good_length)
+	with open(checkpoint_path,mode="r",encoding="utf-8") as checkpointin :
+		for line in checkpointin :
+			yield json.loads(line)
+
+def remove_checkpoint(checkpoint_path) :
+	'''Delete a checkpoint file once it is no longer needed, along with its folder if that is now empty'''
+	if checkpoint_path and checkpoint_path.exists() :
+		checkpoint_path.unlink()
+		try :
+			checkpoint_path.parent.rmdir()
+		except OSError :
+			## other checkpoints still in the folder
+			pass;
+
+def get_record_pages(s,url,headers,myparams,max_records=0,stats=None,checkpoint_path=None,fields=None,use_cache=True) :
+	'''Generator working through the deep paging of the API for one set of parameters, yielding the decoded JSON of each page in turn
+	(with each record cut down to just the given fields, if any are given).
+	If a checkpoint file is given, pages already saved in it are used first, and each new page is added to it.'''
+	if debug :
+		## Open a file to write the json response out into, reasonably nicely formatted using pprint = pretty print
+		responseout=open("response.json","w",encoding="utf-8")
+	records_retrieved=0
+	checkpointout=None
+	if checkpoint_path :
+		storedPages=read_checkpoint(checkpoint_path)
+	else :
+		storedPages=iter(())
+	try :
+		while True :
+			rjson=next(storedPages,None)
+			page_info={}
+			if rjson is not None :
+				## This page was already retrieved by an earlier run, carry on from where it left off
+				myparams["sps.batchStartMark"]=rjson["batchStartMark"]
+				count_stat(stats,"checkpoint_pages")
+				page_info["checkpoint"]=True
+			else :
+				rjson=get_page_json(s,url,headers,myparams,stats,fields,page_info,use_cache)
+				if checkpoint_path :
+					if not checkpointout :
+						checkpoint_path.parent.mkdir(exist_ok=True,parents=True)
+						checkpointout=open(checkpoint_path,mode="a",encoding="utf-8")
+					## write the whole page as a single line, so an interrupted write can be detected by the missing line end
+					checkpointout.write(json.dumps({"batchStartMark":myparams["sps.batchStartMark"],"nextBatchMark":rjson["nextBatchMark"],"count":rjson["count"],"records":rjson["records"]})+"\n")
+					checkpointout.flush()
+			
+			if records_retrieved == 0 :
+				## print total (expected) record count from response
+				print("Total records to be retrieved:",rjson["count"])
+			records_retrieved+=len(rjson["records"])
+			
+			## So we can see progress, print out original value for batchStartMark, the returned value for batchStartMark, and the number of records returned by this request,
+			## along with the size of the response over the network and once decompressed (if it had to be requested from the API)
+			if page_info.get("wire_bytes") :
+				print(myparams["sps.batchStartMark"],rjson["nextBatchMark"],str(len(rjson["records"])),"(",page_info["wire_bytes"],"bytes transferred,",page_info["decoded_bytes"],"bytes decoded )")
+			else :
+				print(myparams["sps.batchStartMark"],rjson["nextBatchMark"],str(len(rjson["records"])))
+			
+			## Keep the details of each page for the run report
+			if stats is not None :
+				page_info["batchStartMark"]=myparams["sps.batchStartMark"]
+				page_info["records"]=len(rjson["records"])
+				with stats_lock :
+					stats.setdefault("pages",[]).append(page_info)
+			
+			if debug :
+				## by default, write out just the records portion included in the returned data. Swap which of the two lines immediately below is commented to write out the whole response
+				# responseout.write(pprint.pformat(rjson))
+				responseout.write(pprint.pformat(rjson["records"]))
+				
+				##Uncomment the following line to also show the output in the command line window
+				# pprint.pprint(rjson)
+			
+			yield rjson
+			
+			## Keep requesting data until we have retrieved all records, at that point the nextBatchMark is not updated, so the value used for the call will match the returned value
+			if myparams["sps.batchStartMark"] == rjson["nextBatchMark"] or myparams["sps.batchStartMark"] == "null" :
+				break
+			## Stop early once we've passed any limit on the number of records set in the input CSV
+			if max_records and records_retrieved >= max_records :
+				break
+			## Update the parameter set with the returned value for nextBatchMark so we can get the next portion of data with our next request
+			myparams["sps.batchStartMark"]=rjson["nextBatchMark"]
+	finally :
+		if debug :
+			responseout.close()
+		if checkpointout :
+			checkpointout.close()
+
+def prefetch(pages,stats=None) :
+	'''Generator yielding the pages from another generator (eg get_record_pages), which is run in a separate thread keeping up to prefetch_pages
+	pages queued ahead. Any error raised while fetching is raised again here, and if this generator is closed early the fetching thread is stopped.'''
+	if not prefetch_pages :
+		yield from pages
+		return
+	queued=queue.Queue(maxsize=prefetch_pages)
+	stop=threading.Event()
+	finished=object()
+	
+	def put(item) :
+		## wait for room in the queue, giving up if the consumer has stopped
+		while not stop.is_set() :
+			try :
+				queued.put(item,timeout=0.1)
+				return True
+			except queue.Full :
+				pass;
+		return False
+	
+	def fetch() :
+		try :
+			for page in pages :
+				if not put((page,None)) :
+					break
+		except Exception as error :
+			put((finished,error))
+		else :
+			put((finished,None))
+		finally :
+			pages.close()
+	
+	fetcher=threading.Thread(target=fetch,daemon=True)
+	fetcher.start()
+	try :
+		while True :
+			## time spent here is time the processing of pages had to wait for the API
+			with time_stat(stats,"prefetch_wait_seconds") :
+				page, error=queued.get()
+			if page is finished :
+				if error :
+					raise error
+				return
+			yield page
+	finally :
+		stop.set()
+		fetcher.join()
+
+def reference_sort_key(reference) :
+	'''Key for sorting catalogue references so that numeric parts sort as numbers, eg SC 8/2/10 comes after SC 8/2/9'''
+	return [(0,int(part)) if part.isdigit() else (1,part) for part in regex.findall(r"\d+|\D+",str(reference))]
+
+def probe_count(s,url,headers,myparams,stats=None,use_cache=True) :
+	'''Make a quick request for just one record, to find how many records a search will return'''
+	probeparams=dict(myparams)
+	probeparams["sps.resultsPageSize"]=1
+	probeparams["sps.batchStartMark"]="*"
+	return int(get_page_json(s,url,headers,probeparams,stats,use_cache=use_cache)["count"])
+
+def plan_date_shards(s,url,headers,myparams,stats=None,shard_size=None,count=None,use_cache=True) :
+	'''Probe the search to get the total record count (unless it's already known), and if it is large split the date range into a list of
+	(dateFrom,dateTo) shards of about shard_size records (date_shard_size by default), otherwise return None'''
+	if shard_size is None :
+		shard_size=date_shard_size
+	if count is None :
+		count=probe_count(s,url,headers,myparams,stats,use_cache)
+	if count <= shard_size :
+		return None
+	
+	dateFrom=datetime.datetime.strptime(myparams["sps.dateFrom"],"%Y-%m-%d").date()
+	dateTo=datetime.datetime.strptime(myparams["sps.dateTo"],"%Y-%m-%d").date()
+	days=(dateTo-dateFrom).days+1
+	## Can't split a range any finer than one day per shard
+	shardcount=min(math.ceil(count/shard_size),days)
+	if shardcount < 2 :
+		return None
+	
+	shards=[]
+	for i in range(shardcount) :
+		shardFrom=dateFrom+datetime.timedelta(days=(i*days)//shardcount)
+		shardTo=dateFrom+datetime.timedelta(days=((i+1)*days)//shardcount-1)
+		shards.append((shardFrom.strftime("%Y-%m-%d"),shardTo.strftime("%Y-%m-%d")))
+	print("Splitting search for",count,"records into",shardcount,"date ranges, from",shards[0][0],"to",shards[-1][1])
+	return shards
+
+def get_shard_records(s,url,headers,myparams,shard,stats=None,checkpoint_path=None,fields=None) :
+	'''Page through the search for just one date range shard, returning the list of all records found'''
+	shardparams=dict(myparams)
+	shardparams["sps.dateFrom"],shardparams["sps.dateTo"]=shard
+	shardparams["sps.batchStartMark"]="*"
+	shardRecords=[]
+	for rjson in get_record_pages(s,url,headers,shardparams,stats=stats,checkpoint_path=checkpoint_path,fields=fields) :
+		shardRecords.extend(rjson["records"])
+	return shardRecords
+
+def get_shard_checkpoint_paths(checkpoint_path,shards,kind="shard") :
+	'''Each date range shard keeps its own checkpoint file, named after the one for the whole row plus the shard's date range, so that pages
+	saved for one date range are never read back for another (the date ranges change whenever the number of records found does).
+	Segments of an incremental refresh (kind "segment") have their own files, as they keep whole records rather than just discovery_columns.'''
+	if not checkpoint_path :
+		return [None for shard in shards]
+	return [checkpoint_path.with_name(f"{checkpoint_path.stem}_{kind}_{shard[0] or 'all'}_{shard[1] or 'all'}{checkpoint_path.suffix}") for shard in shards]
+
+def remove_stale_checkpoints(checkpoint_path,kind,checkpoint_paths) :
+	'''Delete checkpoint files left by an interrupted earlier run for date ranges which are no longer being used'''
+	if not checkpoint_path or not checkpoint_path.parent.exists() :
+		return
+	for stale_path in list(checkpoint_path.parent.glob(f"{checkpoint_path.stem}_{kind}_*{checkpoint_path.suffix}")) :
+		if stale_path not in checkpoint_paths :
+			remove_checkpoint(stale_path)
+
+def get_sharded_records(s,url,headers,myparams,shards,stats=None,checkpoint_path=None,fields=None,count=None) :
+	'''Page through all the date range shards at the same time, then merge the results back into a single list in reference order.
+	If the number of records expected for the whole search is given, and the merged list doesn't have that many, None is returned instead.'''
+	shard_checkpoint_paths=get_shard_checkpoint_paths(checkpoint_path,shards)
+	remove_stale_checkpoints(checkpoint_path,"shard",shard_checkpoint_paths)
+	## id and reference are always needed to put the shards back together
+	if fields :
+		fields=list(fields)+[field for field in ["id","reference"] if field not in fields]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_shard_connections) as executor :
+		futures=[executor.submit(get_shard_records,s,url,headers,myparams,shard,stats,shard_checkpoint_path,fields) for shard,shard_checkpoint_path in zip(shards,shard_checkpoint_paths)]
+		shardResults=[future.result() for future in futures]
+	## A record whose covering dates cross the boundary between two shards will be returned for both, so only keep the first copy of each id
+	myRecords=[]
+	seen_ids=set()
+	for shardRecords in shardResults :
+		for record in shardRecords :
+			if record.get("id") not in seen_ids :
+				seen_ids.add(record.get("id"))
+				myRecords.append(record)
+	## This relies on the API returning a record for every date range its covering dates overlap, if it doesn't then records crossing a
+	## boundary would be missing, so check against the count for the whole search rather than write out a short result
+	if count is not None and len(myRecords) != count :
+		print("WARNING: merged",len(myRecords),"records from",len(shards),"date ranges, but the search returns",count,"- paging through it without splitting instead")
+		return None
+	myRecords.sort(key=lambda record: reference_sort_key(record.get("reference")))
+	print("Merged",len(myRecords),"records from",len(shards),"date ranges")
+	return myRecords
+
+class RecordStore :
+	'''Local SQLite store of the records harvested for each search, and the data extracted from their descriptions, used for incremental refresh
+	and for answering searches locally. Each record is stored once, keyed on its id, with its reference, series and numeric dates in indexed columns
+	so that subsets can be picked out quickly. A harvest of a search is stored as a list of segments (date ranges, or just one segment for the
+	whole search) with the number of records the API reported for each, and the records found in each segment in the order they were returned.
+	Data extracted from descriptions is stored separately for each combination of labels/regex used, and removed when a description changes.'''
+	## Increase this if the tables change, so that a store written by an earlier version is replaced rather than misread
+	schema_version=1
+	
+	def __init__(self,path) :
+		## As with the response cache, all access goes through one connection protected by a lock
+		self.lock=threading.Lock()
+		self.connection=sqlite3.connect(str(path),check_same_thread=False)
+		if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.schema_version :
+			for table in ["records","extractions","harvests","harvest_records"] :
+				self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+			self.connection.execute(f"PRAGMA user_version={self.schema_version}")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, reference TEXT, series TEXT, num_start_date INTEGER, num_end_date INTEGER, "
+			"description TEXT, record TEXT)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS records_reference ON records (reference)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS records_series ON records (series)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS records_dates ON records (num_start_date, num_end_date)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS extractions (id TEXT, extract_key TEXT, extracted TEXT, PRIMARY KEY (id, extract_key))")
+		## Extracted data is only valid for the description it was extracted from
+		self.connection.execute("CREATE TRIGGER IF NOT EXISTS records_description_changed AFTER UPDATE OF description ON records "
+			"WHEN old.description IS NOT new.description BEGIN DELETE FROM extractions WHERE id=old.id; END")
+		self.connection.execute("CREATE TRIGGER IF NOT EXISTS records_deleted AFTER DELETE ON records BEGIN DELETE FROM extractions WHERE id=old.id; END")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS harvests (search_key TEXT PRIMARY KEY, url TEXT, params TEXT, harvested REAL, checked REAL, segments TEXT)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS harvest_records (search_key TEXT, segment INTEGER, position INTEGER, id TEXT, PRIMARY KEY (search_key, segment, position))")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS harvest_records_id ON harvest_records (id)")
+		self.connection.commit()
+	
+	@staticmethod
+	def make_search_key(url,myparams) :
+		'''Hash the search parameters which affect which records are returned (so not the paging parameters)'''
+		normalised={key:value for key,value in myparams.items() if value is not None and key not in ["sps.batchStartMark","sps.resultsPageSize"]}
+		return hashlib.sha256(json.dumps([url,normalised],sort_keys=True).encode("utf-8")).hexdigest()
+	
+	@staticmethod
+	def make_extract_key(desc_fields,labels) :
+		'''Hash the regex and labels used for extraction, so that extracted data is only reused if they haven't changed'''
+		if desc_fields :
+			pattern=[desc_fields.pattern,desc_fields.flags]
+		else :
+			pattern=None
+		return hashlib.sha256(json.dumps([pattern,labels]).encode("utf-8")).hexdigest()
+	
+	def get_harvest(self,search_key) :
+		'''Return the time of the last full harvest of a search and its list of [dateFrom,dateTo,count] segments, or None if it hasn't been harvested'''
+		with self.lock :
+			found=self.connection.execute("SELECT harvested, segments FROM harvests WHERE search_key=?",(search_key,)).fetchone()
+		if not found :
+			return None
+		return {"harvested":found[0],"segments":json.loads(found[1])}
+	
+	def save_harvest(self,search_key,url,myparams,segments,segment_records,full_harvest,verified=True) :
+		'''Store the records fetched for some (or, for a full harvest, all) segments of a search, and the latest segment counts. If the counts
+		weren't verified against the API (ie they came from the response cache), the harvest isn't marked as checked, and a full harvest is
+		marked as out of date so that it's fetched again in full once the API can be reached.'''
+		with self.lock :
+			previous=self.connection.execute("SELECT harvested, checked FROM harvests WHERE search_key=?",(search_key,)).fetchone()
+			if verified :
+				checked=time.time()
+			elif previous :
+				checked=previous[1]
+			else :
+				checked=0
+			if full_harvest :
+				harvested=checked if verified else 0
+				self.connection.execute("DELETE FROM harvest_records WHERE search_key=?",(search_key,))
+			else :
+				harvested=previous[0]
+			for segment, records in segment_records.items() :
+				self.connection.execute("DELETE FROM harvest_records WHERE search_key=? AND segment=?",(search_key,segment))
+				self.connection.executemany("INSERT INTO harvest_records (search_key, segment, position, id) VALUES (?,?,?,?)",
+					((search_key,segment,position,record["id"]) for position, record in enumerate(records)))
+				## update any records already stored, then add the new ones (rather than INSERT OR REPLACE, which would delete the row and with it the
+				## extracted data, even if the description hasn't changed)
+				values=[(record.get("reference"),get_record_series(record.get("reference")),to_integer(record.get("numStartDate")),
+					to_integer(record.get("numEndDate")),record.get("description"),json.dumps(record),record["id"]) for record in records]
+				self.connection.executemany("UPDATE records SET reference=?, series=?, num_start_date=?, num_end_date=?, description=?, record=? WHERE id=?",values)
+				self.connection.executemany("INSERT OR IGNORE INTO records (reference, series, num_start_date, num_end_date, description, record, id) VALUES (?,?,?,?,?,?,?)",values)
+			self.connection.execute("INSERT OR REPLACE INTO harvests (search_key, url, params, harvested, checked, segments) VALUES (?,?,?,?,?,?)",
+				(search_key,url,json.dumps(myparams,sort_keys=True),harvested,checked,json.dumps(segments)))
+			## remove records no longer part of any harvest
+			self.connection.execute("DELETE FROM records WHERE id NOT IN (SELECT id FROM harvest_records)")
+			self.connection.commit()
+	
+	def find_covering_harvest(self,url,myparams,max_age) :
+		'''Return the search key of a harvest, checked against the API within the last max_age seconds, which holds every record the given
+		search would return, or None if there isn't one'''
+		with self.lock :
+			harvests=self.connection.execute("SELECT search_key, params FROM harvests WHERE url=? AND checked>=? ORDER BY checked DESC",(url,time.time()-max_age)).fetchall()
+		for search_key, params in harvests :
+			if search_covers(json.loads(params),myparams) :
+				return search_key
+		return None
+	
+	def get_search_records(self,search_key,extract_key,myparams=None) :
+		'''Return the list of records stored for a search, and a matching list of their extracted data (None where it needs extracting again).
+		If search parameters are given, only the records matching their date range and series are returned.'''
+		conditions=["records.id IN (SELECT id FROM harvest_records WHERE search_key=?)"]
+		values=[extract_key,search_key]
+		if myparams :
+			## a record is included if its covering dates overlap the date range
+			if myparams.get("sps.dateFrom") :
+				conditions.append("num_end_date >= ?")
+				values.append(int(myparams["sps.dateFrom"].replace("-","")))
+			if myparams.get("sps.dateTo") :
+				conditions.append("num_start_date <= ?")
+				values.append(int(myparams["sps.dateTo"].replace("-","")))
+			if myparams.get("sps.recordSeries") :
+				series=get_param_list(myparams["sps.recordSeries"])
+				conditions.append(f"series IN ({','.join('?' for seriesname in series)})")
+				values.extend(series)
+		with self.lock :
+			rows=self.connection.execute("SELECT records.id, record, extracted FROM records LEFT JOIN extractions ON extractions.id=records.id AND extract_key=? "
+				"WHERE "+" AND ".join(conditions),values).fetchall()
+			## keep the order the records were returned in by the API
+			positions={}
+			for position, (record_id,) in enumerate(self.connection.execute("SELECT id FROM harvest_records WHERE search_key=? ORDER BY segment, position",(search_key,))) :
+				## a record whose covering dates cross the boundary between two segments is stored in both, it goes where it was first found
+				positions.setdefault(record_id,position)
+		rows.sort(key=lambda row: positions[row[0]])
+		myRecords=[json.loads(record) for record_id, record, record_extracted in rows]
+		extracted=[json.loads(record_extracted) if record_extracted is not None else None for record_id, record, record_extracted in rows]
+		return myRecords, extracted
+	
+	def save_extracted(self,extract_key,record_ids,extracted) :
+		'''Store the data extracted from the descriptions of the given records'''
+		with self.lock :
+			self.connection.executemany("INSERT OR REPLACE INTO extractions (id, extract_key, extracted) VALUES (?,?,?)",
+				((record_id,extract_key,json.dumps(record_extracted)) for record_id, record_extracted in zip(record_ids,extracted)))
+			self.connection.commit()
+
+def get_record_series(reference) :
+	'''The series of a record is the part of its reference before the first slash, eg SC 8 for SC 8/16/1500'''
+	if not reference :
+		return None
+	return reference.split("/")[0].strip()
+
+def get_param_list(value) :
+	'''Values of a parameter which can be given as a list, as a list with any surrounding spaces removed'''
+	if isinstance(value,str) :
+		value=value.split(",")
+	return [item.strip() for item in value]
+
+def search_covers(held,wanted) :
+	'''Check whether every record returned by a search (wanted) is also returned by a search already held in the record store: the held search
+	must be the same apart from having a date range and series which include those wanted (or none at all)'''
+	## results from the store are put in reference order
+	if wanted.get("sps.sortByOption") not in [None,"REFERENCE_ASCENDING"] :
+		return False
+	for key in set(held) | set(wanted) :
+		if key in ["sps.batchStartMark","sps.resultsPageSize","sps.sortByOption","sps.dateFrom","sps.dateTo","sps.recordSeries"] :
+			continue
+		if (held.get(key) or None) != (wanted.get(key) or None) :
+			return False
+	if held.get("sps.recordSeries") :
+		if not wanted.get("sps.recordSeries") or not set(get_param_list(wanted["sps.recordSeries"])) <= set(get_param_list(held["sps.recordSeries"])) :
+			return False
+	## dates are given as YYYY-MM-DD so can be compared as text
+	if held.get("sps.dateFrom") and (not wanted.get("sps.dateFrom") or wanted["sps.dateFrom"] < held["sps.dateFrom"]) :
+		return False
+	if held.get("sps.dateTo") and (not wanted.get("sps.dateTo") or wanted["sps.dateTo"] > held["sps.dateTo"]) :
+		return False
+	return True
+
+## The record store is opened once the script starts running, if incremental_refresh or local_queries is set
+record_store=None
+
+def get_segment_params(myparams,segment) :
+	'''Parameters for one segment of a search, limited to its date range (if it has one)'''
+	segmentparams=dict(myparams)
+	if segment[0] :
+		segmentparams["sps.dateFrom"],segmentparams["sps.dateTo"]=segment[0],segment[1]
+	segmentparams["sps.batchStartMark"]="*"
+	return segmentparams
+
+def get_segment_records(s,url,headers,myparams,segment,stats=None,checkpoint_path=None,use_cache=True) :
+	'''Page through one segment of a search, returning the number of records the API reports for it and the list of records'''
+	count=0
+	segmentRecords=[]
+	for pagecount, rjson in enumerate(get_record_pages(s,url,headers,get_segment_params(myparams,segment),stats=stats,checkpoint_path=checkpoint_path,use_cache=use_cache)) :
+		if pagecount == 0 :
+			count=int(rjson["count"])
+		segmentRecords.extend(rjson["records"])
+	return count, segmentRecords
+
+def refresh_search(s,url,headers,myparams,stats=None,checkpoint_path=None) :
+	'''Bring the record store up to date for a search, only paging through the segments whose record count has changed since the last harvest
+	(or all of them, if there's no harvest less than refresh_max_age old). Returns the search key and the list of checkpoint files used.'''
+	search_key=RecordStore.make_search_key(url,myparams)
+	harvest=record_store.get_harvest(search_key)
+	## the counts and records must come from the API rather than the response cache, or changes made since they were cached would be missed
+	## (unless working offline with cache_only, in which case the harvest isn't marked as checked against the API)
+	use_cache=cache_only
+	if harvest and (not refresh_max_age or time.time()-harvest["harvested"] <= refresh_max_age) :
+		segments=harvest["segments"]
+		## check the current count for each segment, at the same time
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_shard_connections) as executor :
+			counts=list(executor.map(lambda segment: probe_count(s,url,headers,get_segment_params(myparams,segment),stats,use_cache),segments))
+		changed=[segmentcount for segmentcount, (segment,count) in enumerate(zip(segments,counts)) if count != segment[2]]
+		full_harvest=False
+		print("Incremental refresh:",len(changed),"of",len(segments),"segments changed since harvest of",
+			datetime.datetime.fromtimestamp(harvest["harvested"]).isoformat(timespec="seconds"))
+	else :
+		## Split a search over a date range in reference order into segments, so that future refreshes only need to fetch the segments which change
+		segments=None
+		if myparams.get("sps.dateFrom") and myparams.get("sps.dateTo") and myparams.get("sps.sortByOption") in [None,"REFERENCE_ASCENDING"] :
+			shards=plan_date_shards(s,url,headers,myparams,stats,refresh_segment_size,use_cache=use_cache)
+			if shards :
+				segments=[[shardFrom,shardTo,None] for shardFrom,shardTo in shards]
+		if not segments :
+			segments=[[None,None,None]]
+		changed=list(range(len(segments)))
+		full_harvest=True
+		print("Incremental refresh: no recent harvest of this search, fetching all",len(segments),"segments")
+	count_stat(stats,"segments_fetched",len(changed))
+	count_stat(stats,"segments_reused",len(segments)-len(changed))
+	
+	segment_checkpoint_paths=get_shard_checkpoint_paths(checkpoint_path,segments,"segment")
+	remove_stale_checkpoints(checkpoint_path,"segment",[segment_checkpoint_paths[segmentcount] for segmentcount in changed])
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_shard_connections) as executor :
+		futures={segmentcount:executor.submit(get_segment_records,s,url,headers,myparams,segments[segmentcount],stats,segment_checkpoint_paths[segmentcount],use_cache) for segmentcount in changed}
+		segment_records={}
+		for segmentcount, future in futures.items() :
+			segments[segmentcount][2], segment_records[segmentcount]=future.result()
+	record_store.save_harvest(search_key,url,myparams,segments,segment_records,full_harvest,not cache_only)
+	return search_key, [segment_checkpoint_paths[segmentcount] for segmentcount in changed]
+
+def get_refreshed_dataframe(s,url,headers,myparams,discovery_columns,desc_fields,labels,stats=None,checkpoint_path=None) :
+	'''Refresh a search in the record store, then build the DataFrame for it from the stored records, only extracting data from descriptions
+	which are new or have changed. Returns the DataFrame and the list of checkpoint files used.'''
+	search_key, segment_checkpoint_paths=refresh_search(s,url,headers,myparams,stats,checkpoint_path)
+	extract_key=RecordStore.make_extract_key(desc_fields,labels)
+	myRecords, extracted=record_store.get_search_records(search_key,extract_key)
+	## put the segments back together in reference order, as for a search split into shards
+	in_reference_order=len(record_store.get_harvest(search_key)["segments"]) > 1
+	df=build_stored_dataframe(myRecords,extracted,extract_key,in_reference_order,discovery_columns,desc_fields,labels,stats)
+	return df, segment_checkpoint_paths
+
+def get_local_dataframe(url,myparams,max_records,discovery_columns,desc_fields,labels,stats=None) :
+	'''If a search already held in the record store (and checked against the API within local_query_max_age) covers this search, build the
+	DataFrame for it from the stored records, in reference order. Otherwise return None.'''
+	search_key=record_store.find_covering_harvest(url,myparams,local_query_max_age)
+	if not search_key :
+		return None
+	extract_key=RecordStore.make_extract_key(desc_fields,labels)
+	myRecords, extracted=record_store.get_search_records(search_key,extract_key,myparams)
+	print("Answering search from",len(myRecords),"records already in the record store")
+	count_stat(stats,"local_queries")
+	## paging from the API stops at the end of the page on which max_records is reached, so return the same number of records
+	if max_records and myparams.get("sps.resultsPageSize") :
+		page_size=int(myparams["sps.resultsPageSize"])
+		max_records=-(-max_records // page_size) * page_size
+	df=build_stored_dataframe(myRecords,extracted,extract_key,True,discovery_columns,desc_fields,labels,stats,max_records)
+	return df
+
+def build_stored_dataframe(myRecords,extracted,extract_key,in_reference_order,discovery_columns,desc_fields,labels,stats=None,max_records=0) :
+	'''Build the DataFrame for records read back from the record store, only extracting data from those descriptions without extracted data
+	already stored (which is then saved for next time)'''
+	if in_reference_order :
+		order=sorted(range(len(myRecords)),key=lambda position: reference_sort_key(myRecords[position].get("reference")))
+		myRecords=[myRecords[position] for position in order]
+		extracted=[extracted[position] for position in order]
+	if max_records :
+		myRecords=myRecords[0:max_records]
+		extracted=extracted[0:max_records]
+	missing=[position for position, record_extracted in enumerate(extracted) if record_extracted is None]
+	df=build_dataframe(myRecords,discovery_columns,desc_fields,labels,stats,extracted)
+	record_store.save_extracted(extract_key,[myRecords[position]["id"] for position in missing],[extracted[position] for position in missing])
+	return df
+
+## Now set up various functions that will do the work of applying the regex and splitting out labelled text.
+def extract_labelled_data(descriptions,desc_fields) :
+	'''Run the desc_fields regex once over each description, returning a list with a dictionary of the text for every label_id for each description
+	(empty if there is no match at all)'''
+	## look the search method up once, rather than on every description
+	search=desc_fields.search
+	labelled_rows=[]
+	for description in descriptions :
+		if isinstance(description,str) :
+			match=search(description)
+		else :
+			match=None
+		if match :
+			labelled_rows.append(match.groupdict())
+		else :
+			labelled_rows.append({})
+	return labelled_rows
+
+## Characters trimmed from either end of a possible label
+label_strip_chars="".join((string.whitespace,string.punctuation,string.digits))
+## A possible label is the text before a colon, working back to the nearest character that would normally break up the text, ie a full stop,
+## a square bracket or another colon
+candidate_label_regex=regex.compile(r"([^.\[:]*):")
+
+def compile_known_labels(labels) :
+	'''Build a single regex matching any of the known labels followed by a colon (longest first, so eg "Name(s):" is removed before "Name:")'''
+	if not labels :
+		return None
+	return pattern_registry.compile("|".join(regex.escape(label+":") for label in sorted(labels,key=len,reverse=True)),0)
+
+def other_possible_labels(description,known_labels_regex) :
+	'''Look for any other possible labels within the description by searching for additional colons, returning a list of them or None'''
+	if not isinstance(description,str) or ":" not in description :
+		return None
+	## First remove existing labels from a copy of the description
+	if known_labels_regex :
+		description=known_labels_regex.sub("",description)
+	## Then take the text leading up to each remaining colon as a possible label
+	other_possible_labels=[]
+	for new_label_candidate in candidate_label_regex.findall(description) :
+		new_label_candidate=new_label_candidate.strip(label_strip_chars)
+		if new_label_candidate :
+			other_possible_labels.append(new_label_candidate)
+	## if there's anything in the list of possible labels, return the list, otherwise return None.
+	if other_possible_labels :
+		return other_possible_labels
+	else :
+		return None
+
+def count_other_possible_labels(df,label_counts) :
+	'''Add the possible labels found in a DataFrame to the running totals, counting both the number of times each is used and the number
+	of descriptions it appears in'''
+	for found_labels in df["other_possible_labels"] :
+		if found_labels :
+			label_counts["occurrences"].update(found_labels)
+			label_counts["descriptions"].update(set(found_labels))
+
+def write_other_labels_report(outpath,label_counts) :
+	'''Write out the totals for possible labels, most common first, to a CSV file alongside the output file'''
+	if not label_counts["occurrences"] :
+		return
+	reportpath=outpath.with_name(outpath.name+"_other_possible_labels.csv")
+	with open(reportpath,mode="w",newline="",encoding="utf-8") as reportout :
+		reportwriter=csv.writer(reportout)
+		reportwriter.writerow(["label","occurrences","descriptions"])
+		for label, occurrences in label_counts["occurrences"].most_common() :
+			reportwriter.writerow([label,occurrences,label_counts["descriptions"][label]])
+	print("Summary of",len(label_counts["occurrences"]),"other possible labels written to",reportpath)
+
+def extract_description_data(df,desc_fields,labels,stats=None) :
+	'''Add the columns extracted from the description (by the desc_fields regex) to a DataFrame of records, plus the check for other possible labels'''
+	## Apply data extraction regex to each description in turn, in a single pass giving the text for all labels at once
+	start=time.perf_counter()
+	if desc_fields :
+		print("Finding regex matches")
+		label_ids=list(desc_fields.groupindex.keys())
+		labelled_data=pd.DataFrame(data=extract_labelled_data(df["description"],desc_fields),columns=label_ids,index=df.index)
+		## tidy up a bit, remove any square brackets used to fill out detail to make data more consistent for analysis
+		labelled_data=labelled_data.replace(r"[\[\]]","",regex=True)
+		## Put the data for each label_id into a new column
+		for label_id in label_ids :
+			df[label_id]=labelled_data[label_id]
+		## Look for rows that seem to have no data extracted at all (no text, or only empty text, for every label).
+		df["no_extracted_data"]=~(labelled_data.notna() & labelled_data.ne("")).any(axis=1)
+		for reference, description in df.loc[df["no_extracted_data"],["reference","description"]].itertuples(index=False) :
+			print("no data extracted from description for",reference,description)
+	else :
+		print("no desc_fields regex object")#
+		df["no_extracted_data"]=True
+	count_stat(stats,"extraction_seconds",time.perf_counter()-start)
+	## check for any other possible labels in text that we didn't include in original list of labels
+	start=time.perf_counter()
+	known_labels_regex=compile_known_labels(labels)
+	df["other_possible_labels"]=[other_possible_labels(description,known_labels_regex) for description in df["description"]]
+	count_stat(stats,"other_labels_seconds",time.perf_counter()-start)
+	found_count=int(df["other_possible_labels"].notna().sum())
+	if found_count :
+		print("Additional possible data labels found in",found_count,"descriptions")
+	return df
+
+## The pool of worker processes is only started the first time there's a large enough DataFrame, and is then shared by all rows. The workers are
+## started fresh ("spawn") rather than forked, as by then other threads are running, and a forked worker could inherit a lock (eg for printing)
+## held by one of them, and wait for it forever.
+extraction_pool=None
+extraction_pool_lock=threading.Lock()
+
+def get_extraction_pool() :
+	'''Return the pool of worker processes for extraction, starting it if necessary'''
+	global extraction_pool
+	with extraction_pool_lock :
+		if extraction_pool is None :
+			extraction_pool=concurrent.futures.ProcessPoolExecutor(max_workers=extraction_workers,mp_context=multiprocessing.get_context("spawn"))
+	return extraction_pool
+
+def extract_chunk(chunk,pattern,flags,labels) :
+	'''Run in a worker process: extract the description data for one chunk of a DataFrame, returning it along with the time taken'''
+	## each worker process has its own pattern registry, so the pattern is only compiled once per process rather than for each chunk
+	if pattern is None :
+		desc_fields=None
+	else :
+		desc_fields=pattern_registry.compile(pattern,flags)
+	chunk_stats={}
+	return extract_description_data(chunk,desc_fields,labels,chunk_stats), chunk_stats
+
+def use_extraction_pool(record_count) :
+	'''Whether there are enough records for extraction to be split between the pool of worker processes'''
+	return extraction_workers > 1 and record_count >= parallel_extraction_threshold
+
+def submit_extraction(chunk,desc_fields,labels) :
+	'''Hand a chunk of a DataFrame to the pool of worker processes for extraction, returning the Future for the result'''
+	## the compiled regex is rebuilt in the worker process from its pattern and flags
+	if desc_fields :
+		pattern=desc_fields.pattern
+		flags=desc_fields.flags
+	else :
+		pattern=None
+		flags=0
+	return get_extraction_pool().submit(extract_chunk,chunk,pattern,flags,labels)
+
+def gather_extracted_chunks(chunks,stats=None) :
+	'''Return the list of extracted chunks in their original order, waiting for the results of any handed to the worker processes'''
+	extracted_chunks=[]
+	for chunk in chunks :
+		if isinstance(chunk,concurrent.futures.Future) :
+			chunk, chunk_stats=chunk.result()
+			## times from the worker processes are added together, so can come to more than the time actually taken
+			merge_stats(stats,chunk_stats)
+		extracted_chunks.append(chunk)
+	return extracted_chunks
+
+def extract_description_data_parallel(df,desc_fields,labels,stats=None) :
+	'''Extract the description data for a DataFrame, splitting it into chunks processed by the pool of worker processes if it's large enough,
+	then putting the chunks back together in their original order'''
+	if not use_extraction_pool(len(df)) :
+		return extract_description_data(df,desc_fields,labels,stats)
+	chunks=[df.iloc[chunkstart:chunkstart+extraction_chunk_size] for chunkstart in range(0,len(df),extraction_chunk_size)]
+	print("Extracting data from",len(df),"descriptions in",len(chunks),"chunks using up to",extraction_workers,"worker processes")
+	futures=[submit_extraction(chunk,desc_fields,labels) for chunk in chunks]
+	return pd.concat(gather_extracted_chunks(futures,stats))
+
+def get_extracted_columns(desc_fields) :
+	'''Names of the columns added to a DataFrame by extract_description_data'''
+	if desc_fields :
+		label_ids=list(desc_fields.groupindex.keys())
+	else :
+		label_ids=[]
+	return label_ids+["no_extracted_data","other_possible_labels"]
+
+def merge_extracted_data(df,extracted,desc_fields,labels,stats=None) :
+	'''Add the columns extracted from the descriptions to a DataFrame where some rows already have their extracted data (a dictionary of the
+	extracted columns for each row, or None if it's not known), so that only the other rows go through extraction. The missing entries in the
+	extracted list are filled in.'''
+	extracted_columns=get_extracted_columns(desc_fields)
+	missing=[position for position, row_extracted in enumerate(extracted) if row_extracted is None]
+	print("Extracting data from",len(missing),"new or changed descriptions, reusing data already extracted from",len(df)-len(missing))
+	if missing :
+		new_data=extract_description_data_parallel(df.iloc[missing].copy(),desc_fields,labels,stats)
+		for position, row_extracted in zip(missing,new_data[extracted_columns].to_dict("records")) :
+			row_extracted["no_extracted_data"]=bool(row_extracted["no_extracted_data"])
+			extracted[position]=row_extracted
+	extracted_data=pd.DataFrame(data=extracted,columns=extracted_columns,index=df.index)
+	for column in extracted_columns :
+		df[column]=extracted_data[column]
+	return df
+
+def build_dataframe(records,discovery_columns,desc_fields,labels,stats=None,extracted=None) :
+	'''Create the DataFrame (our equivalent of a spreadsheet) for a list of records, with the description data extracted'''
+	## Select just the fields we're interested in: compared to the original analysis we're also keeping
+	## the machine readable versions of the covering date "startDate","endDate","numStartDate","numEndDate" which should make date related questions easier to handle,
+	## and also places is already pulled out as a separate field in the JSON data, so we might as well take it, though the regex will also pull it out of the description separately
+	with time_stat(stats,"dataframe_seconds") :
+		df=pd.DataFrame(data=records,columns=discovery_columns);
+	count_stat(stats,"records",len(df))
+	if extracted is not None :
+		return merge_extracted_data(df,extracted,desc_fields,labels,stats)
+	return extract_description_data_parallel(df,desc_fields,labels,stats)
+
+def build_paged_dataframe(pages,discovery_columns,desc_fields,labels,stats=None) :
+	'''Build the DataFrame for a search from its pages of records as they arrive, extracting the description data for each chunk of
+	extraction_chunk_size records as soon as it's complete. If the search is large enough (going by the count on the first page) the chunks are
+	handed to the pool of worker processes, otherwise they're processed directly. The chunks are put back together in their original order.'''
+	chunks=[]
+	records=[]
+	use_pool=None
+	
+	def add_chunk() :
+		if use_pool :
+			with time_stat(stats,"dataframe_seconds") :
+				chunk=pd.DataFrame(data=records,columns=discovery_columns);
+			count_stat(stats,"records",len(chunk))
+			chunks.append(submit_extraction(chunk,desc_fields,labels))
+		else :
+			chunks.append(build_dataframe(records,discovery_columns,desc_fields,labels,stats))
+	
+	for rjson in pages :
+		if use_pool is None :
+			use_pool=use_extraction_pool(rjson["count"])
+			if use_pool :
+				print("Extracting data from",rjson["count"],"descriptions in chunks of",extraction_chunk_size,"using up to",extraction_workers,"worker processes")
+		records.extend(rjson["records"])
+		if len(records) >= extraction_chunk_size :
+			add_chunk()
+			records=[]
+	if records or not chunks :
+		add_chunk()
+	
+	extracted_chunks=gather_extracted_chunks(chunks,stats)
+	if len(extracted_chunks) == 1 :
+		return extracted_chunks[0]
+	return pd.concat(extracted_chunks,ignore_index=True)
+
+## Output file extensions written as columnar Parquet or Feather/Arrow IPC files rather than CSV
+columnar_suffixes=[".parquet",".feather",".arrow"]
+## Columns given specific types in columnar output, anything else is written as text
+integer_columns=["numStartDate","numEndDate"]
+list_columns=["places","other_possible_labels"]
+boolean_columns=["no_extracted_data"]
+
+def to_integer(value) :
+	'''Convert a value to an integer if possible, otherwise give None (for missing values in an integer column)'''
+	try :
+		return int(value)
+	except (TypeError,ValueError) :
+		return None
+
+def dataframe_to_arrow(df) :
+	'''Convert a DataFrame of records into an Arrow table with a fixed schema, so that every page or row written to the same file has the same
+	column types (whichever values happen to be present): numeric dates as integers, places etc as lists of text, and everything else as text'''
+	fields=[]
+	arrays=[]
+	for column in df.columns :
+		values=df[column].tolist()
+		if column in integer_columns :
+			arrowtype=pyarrow.int64()
+			values=[to_integer(value) for value in values]
+		elif column in list_columns :
+			arrowtype=pyarrow.list_(pyarrow.string())
+			values=[[str(item) for item in value] if isinstance(value,(list,tuple)) else None for value in values]
+		elif column in boolean_columns :
+			arrowtype=pyarrow.bool_()
+			values=[bool(value) if value is not None and not pd.isna(value) else None for value in values]
+		else :
+			arrowtype=pyarrow.string()
+			values=[None if value is None or (isinstance(value,float) and math.isnan(value)) else str(value) for value in values]
+		fields.append(pyarrow.field(str(column),arrowtype))
+		arrays.append(pyarrow.array(values,type=arrowtype))
+	return pyarrow.Table.from_arrays(arrays,schema=pyarrow.schema(fields))
+
+def write_columnar(df,outpath,arrowWriters) :
+	'''Add a DataFrame to a Parquet or Feather/Arrow IPC file. The file is opened on first use and kept open, with each DataFrame added to it
+	as a new row group (or record batch) rather than rewriting the whole file. The file is closed once all rows for it are done.'''
+	if not pyarrow.available() :
+		raise RuntimeError(f"Output to {outpath.suffix} files needs the pyarrow module, use pip install pyarrow to get it")
+	table=dataframe_to_arrow(df)
+	if str(outpath) not in arrowWriters :
+		if outpath.suffix.lower() == ".parquet" :
+			writer=pyarrow.parquet.ParquetWriter(str(outpath),table.schema)
+		else :
+			writer=pyarrow.ipc.new_file(str(outpath),table.schema)
+		arrowWriters[str(outpath)]=(writer,table.schema)
+	writer,schema=arrowWriters[str(outpath)]
+	if not table.schema.equals(schema) :
+		raise RuntimeError(f"Columns to be added to {outpath} don't match those already in the file (all rows writing to a {outpath.suffix} file must use the same discovery_columns and labels)")
+	writer.write_table(table)
+
+## Maximum number of rows (including the header row) on one worksheet for each type of Excel file. Beyond this the output carries on in a new worksheet.
+excel_max_rows={".xlsx":1048576,".xls":65536}
+
+class ExcelSheetWriter :
+	'''Writes the output for one row of the input CSV to a new worksheet in an Excel workbook, one DataFrame (eg a page of results) at a time.
+	xlsx workbooks are opened in xlsxwriter's constant_memory mode, so each worksheet row is flushed to disk as soon as the next is started rather
+	than the whole workbook being held in memory. If a worksheet fills up, the output carries on in a new worksheet.'''
+	def __init__(self,outpath,sheet_name,excelWriters,excelWriterSheets) :
+		self.outpath=outpath
+		self.excelWriters=excelWriters
+		self.excelWriterSheets=excelWriterSheets
+		self.max_rows=excel_max_rows[outpath.suffix.lower()]
+		if str(outpath) not in excelWriters :
+			## create workbook object, linked to the current outpath by using dictionary.
+			if outpath.suffix.lower() == ".xls" :
+				excelWriters[str(outpath)]=xlwt.Workbook()
+			else :
+				excelWriters[str(outpath)]=xlsxwriter.Workbook(str(outpath),{"constant_memory":True})
+			excelWriterSheets[str(outpath)]=[]
+		## Define sheet name for this Discovery output either the supplied name or just Sheetn+1, where n is the number of sheets already in the workbook
+		if sheet_name :
+			self.base_sheet_name=sheet_name
+		else :
+			self.base_sheet_name="Sheet"+str(len(excelWriterSheets[str(outpath)])+1)
+		self.sheet_count=0
+		self.worksheet=None
+		self.columns=None
+	
+	def add_worksheet(self) :
+		'''Start a new worksheet, with a name which is unique in the workbook, and write the header row'''
+		self.sheet_count+=1
+		if self.sheet_count == 1 :
+			sheet_name=self.base_sheet_name
+		else :
+			## continuation sheets get a number on the end of the name of the first sheet, keeping within Excel's length limit
+			suffix="_"+str(self.sheet_count)
+			sheet_name=self.first_sheet_name[0:30-len(suffix)]+suffix
+			print("Worksheet",self.worksheet_name,"is full, continuing in a new worksheet")
+		## Make sure the sheet name isn't already used by an earlier row writing to the same workbook
+		sheet_name=check_sheet_name_unique(sheet_name,self.outpath,self.excelWriterSheets)
+		print("Final sheet name",sheet_name)
+		self.excelWriterSheets[str(self.outpath)].append(sheet_name)
+		self.worksheet_name=sheet_name
+		if self.sheet_count == 1 :
+			self.first_sheet_name=sheet_name
+		workbook=self.excelWriters[str(self.outpath)]
+		if self.outpath.suffix.lower() == ".xls" :
+			self.worksheet=workbook.add_sheet(sheet_name)
+		else :
+			self.worksheet=workbook.add_worksheet(sheet_name)
+		self.row_number=0
+		self.write_row(self.columns)
+	
+	def write_row(self,values) :
+		'''Write one row of values to the current worksheet'''
+		for column_number, value in enumerate(values) :
+			if value is None :
+				continue
+			if isinstance(value,(list,tuple)) :
+				## lists (eg places) are written as text, as they would be in CSV output
+				value=str(value)
+			self.worksheet.write(self.row_number,column_number,value)
+		self.row_number+=1
+	
+	def write(self,df) :
+		'''Add the rows of a DataFrame to the worksheet, moving on to a new worksheet whenever the current one is full'''
+		if self.worksheet is None :
+			self.columns=[str(column) for column in df.columns]
+			self.add_worksheet()
+		## convert to plain Python values, with missing values as None so they're left as empty cells
+		for values in df.astype(object).where(df.notna(),None).itertuples(index=False,name=None) :
+			if self.row_number >= self.max_rows :
+				self.add_worksheet()
+			self.write_row(values)
+
+def close_excel_workbook(outpath,workbook) :
+	'''Finish writing an Excel workbook to file once no later rows of the input CSV will write to it'''
+	if outpath.suffix.lower() == ".xls" :
+		## xlwt holds the workbook in memory until it's saved
+		workbook.save(str(outpath))
+	else :
+		workbook.close()
+
+def write_dataframe(df,outpath,arrowWriters,outputmode="w",output_encoding="utf-8",header=True,excelSheet=None) :
+	'''Write a DataFrame of records out to the output file, depending on its extension'''
+	if excelSheet :
+		## We want an actual Excel file, not CSV, written out to its own worksheet
+		excelSheet.write(df)
+	elif outpath.suffix.lower() in columnar_suffixes :
+		## Parquet or Feather/Arrow IPC, rows after the first for the same file are added to it rather than rewriting it
+		write_columnar(df,outpath,arrowWriters)
+	else :
+		## Any other extension will be treated as plain CSV (could extend to do different dialects eg TSV or, custome separators etc)
+		df.to_csv(outpath,index=False,header=header,mode=outputmode,encoding=output_encoding);
+
+def run_search(search,excelWriters,excelWriterSheets,arrowWriters,stats=None,label_counts=None) :
+	'''Carry out the API search for one row of the input CSV, extract the labelled data from the descriptions and write out the results.
+	Returns the list of checkpoint files used, which can be removed once the output is safely saved.'''
+	myparams=search["myparams"]
+	labels=search["labels"]
+	desc_fields=search["desc_fields"]
+	outpath=search["outpath"]
+	outputmode=search["outputmode"]
+	sheet_name=search["sheet_name"]
+	output_encoding=search["output_encoding"]
+	discovery_columns=search["discovery_columns"]
+	max_records=search["max_records"]
+	stream_output=search["stream_output"]
+	print("Running search from input CSV line",search["rownum"])
+	if checkpoint_downloads :
+		checkpoint_path=get_checkpoint_path(search)
+		checkpoint_paths=[checkpoint_path]
+	else :
+		checkpoint_path=None
+		checkpoint_paths=[]
+	
+	## We want data returned as json, and compressed for transfer over the network (requests decompresses it automatically)
+	headers={"Accept": "application/json","Accept-Encoding": "gzip, deflate"}
+
+	## Set the base URL for the API endpoint
+	url=api_url
+
+	## As we'll have to page through the data returned by the endpoint, based on batchStartMark, we run the series of queries within a session,
+	## shared by all rows so that connections are reused
+	s=transport
+	
+	## About to write out file, ensure that parent directories exist (exist=True means the mk_dir won't error if directory already there, parents=True
+	## means all parent directories will also be created if necessary. An error will be raised if there is a file of the same name as a parent directory.
+	outpath.parent.mkdir(exist_ok=True,parents=True)
+	
+	print("output mode",outputmode)
+	
+	## Excel output goes to a new worksheet for each row of the input CSV
+	if outpath.suffix.lower() in [".xls",".xlsx"] :
+		excelSheet=ExcelSheetWriter(outpath,sheet_name,excelWriters,excelWriterSheets)
+	else :
+		excelSheet=None
+	
+	if stream_output :
+		## Streaming: each page of records goes through column selection and extraction as soon as it arrives, and is appended straight to the
+		## CSV output (or added to a columnar file as a new row group, or an Excel worksheet), so only one page of records (plus up to prefetch_pages
+		## pages fetched ahead) is held in memory at a time. Only the first page writes the CSV header row. If anything goes wrong the pages are
+		## closed straight away, which stops the thread fetching them.
+		with contextlib.closing(prefetch(get_record_pages(s,url,headers,myparams,max_records,stats,checkpoint_path,discovery_columns),stats)) as pages :
+			for pagecount, rjson in enumerate(pages) :
+				## the final page of a deep paged search can come back empty, nothing to add to the output in that case
+				if pagecount > 0 and not rjson["records"] :
+					continue
+				df=build_dataframe(rjson["records"],discovery_columns,desc_fields,labels,stats)
+				if label_counts is not None :
+					with time_stat(stats,"other_labels_seconds") :
+						count_other_possible_labels(df,label_counts)
+				with time_stat(stats,"write_seconds") :
+					if pagecount == 0 :
+						write_dataframe(df,outpath,arrowWriters,outputmode,output_encoding,excelSheet=excelSheet)
+					else :
+						write_dataframe(df,outpath,arrowWriters,"a",output_encoding,header=False,excelSheet=excelSheet)
+		return checkpoint_paths
+	
+	## Answer the search from the record store if an earlier search already holds all the records it would return
+	df=None
+	if record_store and local_queries :
+		df=get_local_dataframe(url,myparams,max_records,discovery_columns,desc_fields,labels,stats)
+	
+	if df is None and record_store and not max_records :
+		## Incremental refresh, only fetch and extract what's changed since the last run, then rebuild the output from the record store
+		df, segment_checkpoint_paths=get_refreshed_dataframe(s,url,headers,myparams,discovery_columns,desc_fields,labels,stats,checkpoint_path)
+		checkpoint_paths.extend(segment_checkpoint_paths)
+	elif df is None :
+		## Large searches over a date range can be split into several smaller date ranges which are paged through at the same time, as long as all
+		## records are wanted and the results are to be in reference order (in which they're put back together)
+		shards=None
+		if date_shard_size and not max_records and myparams.get("sps.dateFrom") and myparams.get("sps.dateTo") and myparams.get("sps.sortByOption") in [None,"REFERENCE_ASCENDING"] :
+			count=probe_count(s,url,headers,myparams,stats)
+			shards=plan_date_shards(s,url,headers,myparams,stats,count=count)
+	
+		myRecords=None
+		if shards :
+			## (None if the shards didn't give the expected number of records)
+			myRecords=get_sharded_records(s,url,headers,myparams,shards,stats,checkpoint_path,discovery_columns,count)
+			checkpoint_paths.extend(get_shard_checkpoint_paths(checkpoint_path,shards))
+		if myRecords is not None :
+			## Now create our equivalent of a spreadsheet, called a DataFrame, with the most important columns from the JSON and the data extracted from the description
+			df=build_dataframe(myRecords,discovery_columns,desc_fields,labels,stats)
+		else :
+			## Otherwise build the DataFrame a chunk of records at a time as the pages arrive, while later pages are still being fetched
+			with contextlib.closing(prefetch(get_record_pages(s,url,headers,myparams,max_records,stats,checkpoint_path,discovery_columns),stats)) as pages :
+				df=build_paged_dataframe(pages,discovery_columns,desc_fields,labels,stats)
+	
+	if label_counts is not None :
+		with time_stat(stats,"other_labels_seconds") :
+			count_other_possible_labels(df,label_counts)
+	
+	with time_stat(stats,"write_seconds") :
+		write_dataframe(df,outpath,arrowWriters,outputmode,output_encoding,excelSheet=excelSheet)
+	return checkpoint_paths
+
+## Timers kept for each row of the input CSV, in the order they're given in the run report
+report_timers=["http_seconds","decode_seconds","dataframe_seconds","extraction_seconds","other_labels_seconds","write_seconds"]
+## Columns of the CSV version of the run report, one line per row of the input CSV
+report_columns=["rownum","output_filepath","records","pages","total_seconds"]+report_timers+["wire_bytes","decoded_bytes","cache_hits","cache_misses","checkpoint_pages",
+	"segments_fetched","segments_reused","local_queries","prefetch_wait_seconds","peak_rss_bytes"]
+
+## Profiles of each thread running searches, only used if profile_run is set (Python's profiler only sees the thread it's started in)
+profiles=[]
+
+def make_row_report(search,stats) :
+	'''Gather the counters and timers for one row of the input CSV into a dictionary for the run report'''
+	row_report={"rownum":search["rownum"],"output_filepath":str(search["outpath"]),"pages":len(stats.get("pages",[]))}
+	for column in report_columns :
+		if column not in row_report :
+			row_report[column]=stats.get(column,0)
+	row_report["page_details"]=stats.get("pages",[])
+	return row_report
+
+def write_run_report(row_reports,run_started,total_seconds) :
+	'''Write out the run report as JSON (with the details of every page) and CSV (one line per row of the input CSV)'''
+	reportpath=pathlib.Path(run_report_path)
+	with open(reportpath.with_name(reportpath.name+".json"),mode="w",encoding="utf-8") as reportout :
+		json.dump({"started":run_started,"total_seconds":total_seconds,"peak_rss_bytes":get_peak_rss(),"rows":row_reports},reportout,indent=1)
+	with open(reportpath.with_name(reportpath.name+".csv"),mode="w",newline="",encoding="utf-8") as reportout :
+		reportwriter=csv.DictWriter(reportout,fieldnames=report_columns,extrasaction="ignore")
+		reportwriter.writeheader()
+		reportwriter.writerows(row_reports)
+	print("Run report written to",reportpath.with_name(reportpath.name+".json"),"and",reportpath.with_name(reportpath.name+".csv"))
+
+def print_profile() :
+	'''Combine the profiles of all the threads which ran searches, save them to profile_path and print the slowest functions'''
+	if not profiles :
+		return
+	profile_stats=pstats.Stats(*profiles)
+	profile_stats.dump_stats(profile_path)
+	print("Profile written to",profile_path)
+	profile_stats.sort_stats("cumulative").print_stats(25)
+
+def run_output_group(searches,excelWriters,excelWriterSheets,arrowWriters) :
+	'''Run, in input order, all the searches from the input CSV which write to the same output file, returning the run report for each'''
+	if profile_run :
+		profile=cProfile.Profile()
+		profile.enable()
+	try :
+		return run_searches(searches,excelWriters,excelWriterSheets,arrowWriters)
+	finally :
+		if profile_run :
+			profile.disable()
+			with stats_lock :
+				profiles.append(profile)
+
+def run_output_group_after(dependencies,searches,excelWriters,excelWriterSheets,arrowWriters) :
+	'''Wait for the groups of searches this group depends on to finish (raising any error from them), then run it'''
+	for dependency in dependencies :
+		dependency.result()
+	return run_output_group(searches,excelWriters,excelWriterSheets,arrowWriters)
+
+def get_group_dependencies(searchGroups) :
+	'''When searches are answered from the record store, a group of searches has to wait for any earlier group with a search which covers one of
+	its searches (and is kept in the store), so that those records are already there when it runs. Returns, for each group, the positions of the
+	earlier groups it has to wait for.'''
+	dependencies=[]
+	for groupcount, searchGroup in enumerate(searchGroups) :
+		dependencies.append([earliercount for earliercount in range(groupcount) if any(not earlier["max_records"] and not earlier["stream_output"]
+			and search_covers(earlier["myparams"],search["myparams"]) for earlier in searchGroups[earliercount] for search in searchGroup)])
+	return dependencies
+
+def run_searches(searches,excelWriters,excelWriterSheets,arrowWriters) :
+	'''Run each search in a group with the same output file in turn, then close the output file'''
+	checkpoint_paths=[]
+	row_reports=[]
+	## Running totals of other possible labels found across all the rows for this output file
+	if other_labels_report :
+		label_counts={"occurrences":collections.Counter(),"descriptions":collections.Counter()}
+	else :
+		label_counts=None
+	for search in searches :
+		## Counters for how this row was served, eg hits and misses on the response cache
+		stats={}
+		start=time.perf_counter()
+		checkpoint_paths.extend(run_search(search,excelWriters,excelWriterSheets,arrowWriters,stats,label_counts))
+		stats["total_seconds"]=time.perf_counter()-start
+		if response_cache :
+			print("Input CSV line",search["rownum"],"response cache hits:",stats.get("cache_hits",0),"misses:",stats.get("cache_misses",0))
+		if stats.get("wire_bytes") :
+			print("Input CSV line",search["rownum"],"transferred",stats["wire_bytes"],"bytes from the API, for",stats["decoded_bytes"],"bytes of JSON")
+		if stats.get("checkpoint_pages") :
+			print("Input CSV line",search["rownum"],"resumed from checkpoint,",stats["checkpoint_pages"],"pages already retrieved")
+		if stats.get("local_queries") :
+			print("Input CSV line",search["rownum"],"answered from the record store")
+		elif record_store and not search["max_records"] and not search["stream_output"] :
+			print("Input CSV line",search["rownum"],"incremental refresh fetched",stats.get("segments_fetched",0),"segments, reused",stats.get("segments_reused",0))
+		print("Input CSV line",search["rownum"],f"took {stats['total_seconds']:.2f} seconds:",", ".join(f"{timer[:-8]} {stats.get(timer,0):.2f}" for timer in report_timers))
+		stats["peak_rss_bytes"]=get_peak_rss()
+		row_reports.append(make_row_report(search,stats))
+	## No later rows write to this file, so any Excel workbook can now be finished off and closed (the time taken is counted as part of the last row)
+	start=time.perf_counter()
+	outpath=str(searches[0]["outpath"])
+	if outpath in excelWriters :
+		close_excel_workbook(searches[0]["outpath"],excelWriters[outpath])
+	if outpath in arrowWriters :
+		arrowWriters[outpath][0].close()
+	row_reports[-1]["write_seconds"]+=time.perf_counter()-start
+	if label_counts is not None :
+		write_other_labels_report(searches[0]["outpath"],label_counts)
+	## Output is safely written, the checkpoints aren't needed any more
+	for checkpoint_path in checkpoint_paths :
+		remove_checkpoint(checkpoint_path)
+	return row_reports
+
 ## First, prepare regular expression to be used to pull required info out of record description, the bits with (?P<some_name>...) allow us to refer to bits of the description by name
 ## note though that to match original analysis we actually only need Addressees as places is already returned as a distinct field in the JSON.
 ## used in get_addressees function defined below.
@@ -68,417 +1637,326 @@ def check_sheet_name_unique(test_sheet_name,call_count=0) :
 ## Now try to build regex automatically from a list of labels:
 ##labels=["Petitioners","Name(s)","Addressees","Occupation","Nature of request","Nature of endorsement","Places mentioned","People mentioned"]
 
-## Now take labels from CSV file, input at command line
-inputFile=input("Enter file path or name for CSV input file (or drag and drop), hit enter for default file: ").strip('"')
-## If no name given default to original fixed input
-if not inputFile :
-	inputFile="discovery_api_SearchRecords_input_params.csv"
-paramsIn=pathlib.Path(inputFile)
-
-## check we've got a valid path, if not raise error and exit script
-try :
-	paramsIn.resolve(strict=True)
-except FileNotFoundError:
-	print("Cannot find specified input file, script will exit with error")
-	raise;
-
-with open(paramsIn,mode="r",newline='') as csvParamsIn :
-	dictParamsReader=csv.DictReader(csvParamsIn)
-	print("CSV input file header row:\n",dictParamsReader.fieldnames)
-	
-	## for multirow input files, keep track 
-	current_output_filepath=None
-	desc_fields=None
-	output_filepaths=set()
-	excelWriters={}
-	excelWriterSheets={}
+def read_params_csv(paramsIn) :
+	'''Read the input CSV file, returning a list of the searches to be run (a dictionary of everything needed to run each row)'''
+	with open(paramsIn,mode="r",newline='') as csvParamsIn :
+		dictParamsReader=csv.DictReader(csvParamsIn)
+		print("CSV input file header row:\n",dictParamsReader.fieldnames)
 	
-	for row in dictParamsReader :
-		## if there is a "labels" column in the input CSV, and that actually has some content, break up into list by splitting on commas
-		if "labels" in row :
-			if row["labels"] :
-				labels=row.pop("labels").split(",")
-			elif "labels" in row :
-				## otherwise just create an empty list
-				labels=[]
-				del row["labels"]
-		else :
-			labels=[]
-		
-		## initialise list for the individual regex groups that will be created from the label list
-		descfields_list=[]
-
-		## Go through the label list for each label in turn, construct a normalised label id, and construct the high level regex group for that label 
-		## and its related text.  If regex column also set, that will take priority.
-		for label in labels :
-			## construct the normalised label_id, add to list of label_ids
-			label_id=label
-			## remove punctuation characters
-			for char in string.punctuation :
-				label_id=label_id.replace(char,"")
-			## replace whitespace characters with underscore
-			for char in string.whitespace :
-				label_id=label_id.replace(char,"_")
-			## casefold, to lower case as aggressively as possible as defined in Unicode
-			label_id=label_id.casefold()
-			## construct the group for the label and its associated text, make sure any regex metacharacters are escaped to avoid unexpected results.
-			escaped_label=regex.escape(label)
-			relabelgroup=r"("+escaped_label+r":( )?"+r"(?P<"+label_id+r">.*?)(\. |$))?"
-			descfields_list.append(relabelgroup)
-			# print(str(labels))
-		## Now build the full regex, join the elements of the list into one big string using empty string as the joining character (making each group optional):
-		redescfields="".join(descfields_list)
-		
-		## if specific regex supplied, compile it, and this will take priority over any label list supplied
-		if "regex" in row :
-			if row["regex"] :
-				desc_fields=regex.compile(row.pop("regex"), flags=regex.POSIX|regex.VERSION1)
-				print("regex for extracting data from description:",desc_fields.pattern)
+		## for multirow input files, keep track 
+		current_output_filepath=None
+		output_filepaths=set()
+		searches=[]
+	
+		for row in dictParamsReader :
+			## if there is a "labels" column in the input CSV, and that actually has some content, break up into list by splitting on commas
+			if "labels" in row :
+				if row["labels"] :
+					labels=row.pop("labels").split(",")
+				elif "labels" in row :
+					## otherwise just create an empty list
+					labels=[]
+					del row["labels"]
 			else :
-				del row["regex"]
+				labels=[]
 		
-		if redescfields :
-			if not desc_fields :
-				## And create the compiled regex object (from this we can get the list of label_ids by using desc_fields.groupindex.keys() ).
-				desc_fields=regex.compile(redescfields, flags=regex.POSIX|regex.VERSION1)   ## revised version using regex library to get left longest match using POSIX flag under VERSION1
+			## if specific regex supplied, compile it, and this will take priority over any label list supplied. Otherwise build the regex from the labels.
+			## Compiled regexes are held in the pattern registry, so rows sharing the same regex or labels reuse the one already compiled.
+			pattern=None
+			if "regex" in row :
+				pattern=row.pop("regex")
+			desc_fields=make_desc_fields(labels,pattern)
+			if desc_fields :
 				## Confirm the regex to be used
 				print("regex for extracting data from description:",desc_fields.pattern)
-				# label_start=regex.compile(r"(?r)(?<start>:|(. )|\[|\])")
-		elif desc_fields :
-			pass;
-		else :
-			desc_fields=None
 		
-		## Look for other parameters that don't form part of the API call
-		if "output_filepath" in row :
-			if row["output_filepath"] :
-				if row["output_filepath"].upper() == "APPEND" :
-					if current_output_filepath :
-						outpath=current_output_filepath
-						row.pop("output_filepath")
-					else :
-						raise RuntimeError("Output file specified as 'APPEND' but no valid path given in previous row")
-				else :
-					outpath=pathlib.Path(row.pop("output_filepath"))
-					print("sanitising input_filepath to ensure interoperability on Windows and *nix")
-					cleanOutpath=None
-					for pathcount, pathpart in enumerate(outpath.parts) :
-						if pathpart == outpath.anchor :
-							cleanOutpath=pathlib.Path(pathpart)
+			## Look for other parameters that don't form part of the API call
+			if "output_filepath" in row :
+				if row["output_filepath"] :
+					if row["output_filepath"].upper() == "APPEND" :
+						if current_output_filepath :
+							outpath=current_output_filepath
+							row.pop("output_filepath")
 						else :
-							if cleanOutpath :
-								if (cleanOutpath / pathpart).exists() :
-									cleanOutpath=cleanOutpath/pathpart
-								else :
-									cleanPathPart=pathvalidate.sanitize_filename(pathpart)
-									cleanOutpath=cleanOutpath / cleanPathPart
+							raise RuntimeError("Output file specified as 'APPEND' but no valid path given in previous row")
+					else :
+						outpath=pathlib.Path(row.pop("output_filepath"))
+						print("sanitising input_filepath to ensure interoperability on Windows and *nix")
+						cleanOutpath=None
+						for pathcount, pathpart in enumerate(outpath.parts) :
+							if pathpart == outpath.anchor :
+								cleanOutpath=pathlib.Path(pathpart)
 							else :
-								if pathlib.Path(pathpart).exists() :
-									cleanOutpath=pathlib.Path(pathpart)
+								if cleanOutpath :
+									if (cleanOutpath / pathpart).exists() :
+										cleanOutpath=cleanOutpath/pathpart
+									else :
+										cleanPathPart=pathvalidate.sanitize_filename(pathpart)
+										cleanOutpath=cleanOutpath / cleanPathPart
 								else :
-									cleanPathPart=pathvalidate.sanitize_filename(pathpart)
-									cleanOutpath=pathlib.Path(cleanPathPart)
-					print(str(cleanOutpath))
-					outpath=cleanOutpath.resolve()
-					current_output_filepath=outpath
-					print("output filpath set to:",outpath)
+									if pathlib.Path(pathpart).exists() :
+										cleanOutpath=pathlib.Path(pathpart)
+									else :
+										cleanPathPart=pathvalidate.sanitize_filename(pathpart)
+										cleanOutpath=pathlib.Path(cleanPathPart)
+						print(str(cleanOutpath))
+						outpath=cleanOutpath.resolve()
+						current_output_filepath=outpath
+						print("output filpath set to:",outpath)
+				else :
+					raise RuntimeError("No output file specified")
 			else :
 				raise RuntimeError("No output file specified")
-		else :
-			raise RuntimeError("No output file specified")
 		
-		if "excel_sheet_name" in row :
-			if row["excel_sheet_name"] :
-				sheet_name=row.pop("excel_sheet_name")
-				## Remove characters 
-				if not (current_output_filepath.suffix == ".xls" or current_output_filepath.suffix == ".xlsx") :
-					print("Output file is not an Excel spreadsheet, sheet name will be ignored.")
+			if "excel_sheet_name" in row :
+				if row["excel_sheet_name"] :
+					sheet_name=row.pop("excel_sheet_name")
+					## Remove characters 
+					if not (current_output_filepath.suffix == ".xls" or current_output_filepath.suffix == ".xlsx") :
+						print("Output file is not an Excel spreadsheet, sheet name will be ignored.")
+					else :
+						for char in r"*|\/?:[]" :
+							if char in sheet_name :
+								sheet_name=sheet_name.replace(char,"")
+								print("removed unsupported character",char,"from given sheet_name")
+						if len(sheet_name) > 30 :
+							sheet_name=sheet_name[0:31]
+							print("supplied sheet name was too long: truncated to",sheet_name)
 				else :
-					for char in r"*|\/?:[]" :
-						if char in sheet_name :
-							sheet_name=sheet_name.replace(char,"")
-							print("removed unsupported character",char,"from given sheet_name")
-					if len(sheet_name) > 30 :
-						sheet_name=sheet_name[0:31]
-						print("supplied sheet name was too long: truncated to",sheet_name)
-					sheet_name=check_sheet_name_unique(sheet_name)
-					print("Final sheet name",sheet_name)
+					sheet_name=None
+					del row["excel_sheet_name"]
 			else :
 				sheet_name=None
-				del row["excel_sheet_name"]
-		else :
-			sheet_name=None
 		
-		if "output_encoding" in row :
-			if row["output_encoding"] :
-				output_encoding=row.pop("output_encoding")
-				if output_encoding.upper() == "LOCALE" :
-					output_encoding=locale.getpreferredencoding()
+			if "output_encoding" in row :
+				if row["output_encoding"] :
+					output_encoding=row.pop("output_encoding")
+					if output_encoding.upper() == "LOCALE" :
+						output_encoding=locale.getpreferredencoding()
+				else :
+					output_encoding="utf-8"
+					del row["output_encoding"] 
 			else :
 				output_encoding="utf-8"
-				del row["output_encoding"] 
-		else :
-			output_encoding="utf-8"
 		
-		if "discovery_columns" in row :
-			if row["discovery_columns"] :
-				discovery_columns=row.pop("discovery_columns").split(",")
+			if "discovery_columns" in row :
+				if row["discovery_columns"] :
+					discovery_columns=row.pop("discovery_columns").split(",")
+				else :
+					discovery_columns=default_discovery_columns
+					del row["discovery_columns"]
 			else :
-				discovery_columns=["reference","coveringDates","startDate","endDate","numStartDate","numEndDate","description","id","places"]
-				del row["discovery_columns"]
-		else :
-			discovery_columns=["reference","coveringDates","startDate","endDate","numStartDate","numEndDate","description","id","places"]
+				discovery_columns=default_discovery_columns
 		
-		if "max_records" in row :
-			if row["max_records"] :
-				max_records=int(row.pop("max_records"))
+			if "max_records" in row :
+				if row["max_records"] :
+					max_records=int(row.pop("max_records"))
+				else :
+					max_records=0
+					del row["max_records"]
 			else :
 				max_records=0
-				del row["max_records"]
-		else :
-			max_records=0
 		
-		## Now construct the API call.
-		## For use via the Python requests library the parameters (following the ? in the URLs above) are expressed as a Python dictionary of key-value pairs,
-		## if a parameter is used with several different values (as in the first URL), the multiple values are expressed as Python list as in the first example.
-		## The parameters used are explained below.  The only mandatory parameter is sps.searchQuery - but that can be set to the wildcard *.
-		## The full list of available parameters can be found via the sandbox link above.
-		# myparams={"sps.recordSeries":["ADM 159","ADM 188","ADM 337","ADM 339","ADM 362","ADM 363"],"sps.recordCollections":["Records","DigitisedRecords"],"sps.catalogueLevels":"Level7","sps.searchQuery":"Cox JX 125015"} #,"sps.lastName":"Cox","sps.number":"JX 125015"
-		#myparams={"sps.recordSeries":["SC 8"],"sps.dateFrom":"1360-01-01","sps.dateTo":"1380-12-31","sps.catalogueLevels":"Level7","sps.searchQuery":"*","sps.sortByOption":"REFERENCE_ASCENDING","sps.batchStartMark":"*","sps.resultsPageSize":1000}
-		## "sps.recordSeries":["SC 8"] - set the record series to be searched to SC 8
+			if "stream_output" in row :
+				if row["stream_output"] :
+					stream_output=row.pop("stream_output").strip().lower() in ["true","yes","y","1"]
+				else :
+					stream_output=False
+					del row["stream_output"]
+			else :
+				stream_output=False
+		
+			## Now construct the API call.
+			## For use via the Python requests library the parameters (following the ? in the URLs above) are expressed as a Python dictionary of key-value pairs,
+			## if a parameter is used with several different values (as in the first URL), the multiple values are expressed as Python list as in the first example.
+			## The parameters used are explained below.  The only mandatory parameter is sps.searchQuery - but that can be set to the wildcard *.
+			## The full list of available parameters can be found via the sandbox link above.
+			# myparams={"sps.recordSeries":["ADM 159","ADM 188","ADM 337","ADM 339","ADM 362","ADM 363"],"sps.recordCollections":["Records","DigitisedRecords"],"sps.catalogueLevels":"Level7","sps.searchQuery":"Cox JX 125015"} #,"sps.lastName":"Cox","sps.number":"JX 125015"
+			#myparams={"sps.recordSeries":["SC 8"],"sps.dateFrom":"1360-01-01","sps.dateTo":"1380-12-31","sps.catalogueLevels":"Level7","sps.searchQuery":"*","sps.sortByOption":"REFERENCE_ASCENDING","sps.batchStartMark":"*","sps.resultsPageSize":1000}
+			## "sps.recordSeries":["SC 8"] - set the record series to be searched to SC 8
 		
-		## Now take from input CSV file
-		for key in ["sps.recordSeries","sps.references","sps.recordCollections","sps.timePeriods","sps.departments","sps.taxonomySubjects","sps.closureStatuses","sps.searchRestrictionFields"] :
-			## if a key in the list is present in the input CSV and has some content, split the content to turn it into a list for the url parameter construction
-			if key in row and row[key] :
-				row[key] = row[key].split(",")
+			## Now take from input CSV file
+			for key in ["sps.recordSeries","sps.references","sps.recordCollections","sps.timePeriods","sps.departments","sps.taxonomySubjects","sps.closureStatuses","sps.searchRestrictionFields"] :
+				## if a key in the list is present in the input CSV and has some content, split the content to turn it into a list for the url parameter construction
+				if key in row and row[key] :
+					row[key] = row[key].split(",")
 		
-		## Make sure empty keys are set to None, rather than empty string, then they'll be ignored in URL construction
-		## Also look out for any unexpected columns (not starting sps.) in CSV so we can warn and ignore
-		extraKeys=[]
-		for key in row :
-			if row[key] == "" :
-				row[key]=None
-			if not key.startswith("sps.") :
-				extraKeys.append(key)
+			## Make sure empty keys are set to None, rather than empty string, then they'll be ignored in URL construction
+			## Also look out for any unexpected columns (not starting sps.) in CSV so we can warn and ignore
+			extraKeys=[]
+			for key in row :
+				if row[key] == "" :
+					row[key]=None
+				if not key.startswith("sps.") :
+					extraKeys.append(key)
 				
-		for key in extraKeys :
-			print("unexpected CSV column:",key,". Content will be ignored")
-			row.pop(key)
-			del row[key]
+			for key in extraKeys :
+				print("unexpected CSV column:",key,". Content will be ignored")
+				row.pop(key)
+				del row[key]
 		
-		myparams=row
-		# print(str(myparams))
-		## "sps.dateFrom":"1360-01-01","sps.dateTo":"1380-12-31" - set the date range we're interested (based on the Covering Dates of the record)
-		## "sps.catalogueLevels":"Level7" - define what type of records we're interested in Level7 indicates items, in the main TNA catalogue that is the lowest level, 1 = lettercode, 2 = division, 3 = series, 4 = subseries, 5 = subsubseries, 6 = piece
-		## "sps.searchQuery":"*" - we're searching with a wildcard as we just want everything in the series within the given date range, this could be set to an explicit string for more specific searches
-		## "sps.sortByOption":"REFERENCE_ASCENDING" - results will be sorted in reference order from lowest to highest.  This will only be done if fewer than 10000 records are returned
-		## "sps.batchStartMark":"*" - enables deep paging of results, requery updating this with the value included in the returned data to get the next page of result.
-		## "sps.resultsPageSize":1000 - number of records to be returned in each page of results, 1000 is the maximum.
+			myparams=row
+			# print(str(myparams))
+			## "sps.dateFrom":"1360-01-01","sps.dateTo":"1380-12-31" - set the date range we're interested (based on the Covering Dates of the record)
+			## "sps.catalogueLevels":"Level7" - define what type of records we're interested in Level7 indicates items, in the main TNA catalogue that is the lowest level, 1 = lettercode, 2 = division, 3 = series, 4 = subseries, 5 = subsubseries, 6 = piece
+			## "sps.searchQuery":"*" - we're searching with a wildcard as we just want everything in the series within the given date range, this could be set to an explicit string for more specific searches
+			## "sps.sortByOption":"REFERENCE_ASCENDING" - results will be sorted in reference order from lowest to highest.  This will only be done if fewer than 10000 records are returned
+			## "sps.batchStartMark":"*" - enables deep paging of results, requery updating this with the value included in the returned data to get the next page of result.
+			## "sps.resultsPageSize":1000 - number of records to be returned in each page of results, 1000 is the maximum.
 
-		## The only header required is that to indicate we want data returned as json
-		headers={"Accept": "application/json"}
+			## If output file has already been used, switch file mode to append so we don't overwrite existing data, or to pick an existing writer
+			## if we're using Excel output.  Each Excel worksheet is written out as soon as its row finishes, and the workbook closed after the last row using it.
+			if outpath in output_filepaths :
+				outputmode="a"
+			else :
+				outputmode="w"
+			## Make sure the outpath is in the set of used filepaths
+			output_filepaths.add(outpath)
+		
+			## Keep everything needed to run this row, the search itself is carried out once the whole input file has been read
+			searches.append({"rownum":dictParamsReader.line_num,"myparams":myparams,"labels":labels,"desc_fields":desc_fields,"outpath":outpath,"outputmode":outputmode,
+				"sheet_name":sheet_name,"output_encoding":output_encoding,"discovery_columns":discovery_columns,"max_records":max_records,"stream_output":stream_output})
+	return searches
 
-		## Set the base URL for the API endpoint
-		url="http://discovery.nationalarchives.gov.uk/API/search/v1/records"
+def start_transport() :
+	'''Open the response cache, the record store (if incremental_refresh is set) and the shared transport used for all requests to the API,
+	if they aren't already open'''
+	global response_cache, record_store, transport
+	if response_cache is None and response_cache_path :
+		response_cache=ResponseCache(response_cache_path,response_cache_ttl,response_cache_max_bytes)
+	if record_store is None and (incremental_refresh or local_queries) :
+		record_store=RecordStore(record_store_path)
+	if transport is None :
+		transport=DiscoveryTransport()
 
-		## As we'll have to page through the data returned by the endpoint, based on batchStartMark, we run the series of queries within a session
-		s=requests.Session()
+def run_params_csv(paramsIn) :
+	'''Run all the searches in an input CSV file, writing out the results, and return the run report for each row'''
+	run_started=datetime.datetime.now().isoformat(timespec="seconds")
+	start_transport()
+	searches=read_params_csv(paramsIn)
+	excelWriters={}
+	excelWriterSheets={}
+	arrowWriters={}
+	
+	## Rows writing to the same output file have to be written in input order, so gather them into one group per output file. Each group is run
+	## in sequence, but separate groups are independent of each other so can be run at the same time.
+	outputGroups={}
+	for search in searches :
+		outputGroups.setdefault(str(search["outpath"]),[]).append(search)
+	searchGroups=list(outputGroups.values())
+	## Except that if searches can be answered from the record store, a group waits for any earlier group holding the records it needs
+	if record_store and local_queries :
+		dependencies=get_group_dependencies(searchGroups)
+	else :
+		dependencies=[[] for searchGroup in searchGroups]
 
-		## make the first GET request, put the response into variable r.  See http://docs.python-requests.org/en/master/user/quickstart/ for info
-		r=s.get(url, headers=headers, params=myparams);
+	run_start=time.perf_counter()
+	row_reports=[]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_rows) as executor :
+		## groups are started in order, so the groups each one waits for will already have been started (there's no risk of them all waiting)
+		futures=[]
+		for searchGroup, groupDependencies in zip(searchGroups,dependencies) :
+			futures.append(executor.submit(run_output_group_after,[futures[earliercount] for earliercount in groupDependencies],
+				searchGroup,excelWriters,excelWriterSheets,arrowWriters))
+		## Wait for each group in turn, if any of them failed this will raise the error here
+		for future in futures :
+			row_reports.extend(future.result())
+	row_reports.sort(key=lambda row_report: row_report["rownum"])
+	
+	if run_report_path :
+		write_run_report(row_reports,run_started,time.perf_counter()-run_start)
+	if profile_run :
+		print_profile()
+	return row_reports
 
-		## check we have an OK response from the server (ie not a 404 not found etc), an exception will be raised, terminating script execution if not
-		r.raise_for_status()
+def fetch_records(myparams,max_records=0,fields=None) :
+	'''Page through a search of the API, given as a dictionary of sps. parameters, returning the list of all records found (with each record
+	cut down to just the given fields, if any are given)'''
+	start_transport()
+	## the paging updates sps.batchStartMark, so work on a copy of the parameters
+	myparams=dict(myparams)
+	myparams.setdefault("sps.batchStartMark","*")
+	headers={"Accept": "application/json","Accept-Encoding": "gzip, deflate"}
+	myRecords=[]
+	for rjson in get_record_pages(transport,api_url,headers,myparams,max_records,fields=fields) :
+		myRecords.extend(rjson["records"])
+	return myRecords
 
-		## use the built-in JSON interpreter to give us Python data structures (lists/dicts) representation the JSON returned from the server
-		rjson=r.json()
+def make_desc_fields(labels=None,pattern=None) :
+	'''Compile the regex for extracting data from descriptions: the given pattern if there is one, otherwise one built from the list of labels
+	(or None if neither is given)'''
+	if pattern :
+		return pattern_registry.compile(pattern)
+	if labels :
+		## revised version using regex library to get left longest match using POSIX flag under VERSION1 (from the compiled regex object we can get
+		## the list of label_ids by using desc_fields.groupindex.keys() ).
+		return pattern_registry.compile(build_label_pattern(tuple(labels)))
+	return None
 
-		## print total (expected) record count from response
-		print("Total records to be retrieved:",rjson["count"])
+def main(argv=None) :
+	'''Command line entry point: run the searches in the input CSV given on the command line, or asked for if there isn't one'''
+	global api_url, response_cache_path, cache_only, checkpoint_downloads, incremental_refresh, record_store_path, local_queries, max_concurrent_rows
+	global extraction_workers, requests_per_second, run_report_path, profile_run, debug
+	parser=argparse.ArgumentParser(description="Download catalogue data from the Discovery API SearchRecords endpoint for each row of an input CSV file, "
+		"extracting labelled data from the descriptions. Options override the settings near the top of the script.")
+	parser.add_argument("params_csv",nargs="?",help="input CSV file of search parameters (if not given, you will be asked for it)")
+	parser.add_argument("--api-url",default=api_url,help="SearchRecords API endpoint (default: %(default)s)")
+	parser.add_argument("--cache",default=response_cache_path,metavar="PATH",help="response cache file (default: %(default)s)")
+	parser.add_argument("--no-cache",action="store_true",help="don't use the response cache")
+	parser.add_argument("--cache-only",action="store_true",default=cache_only,help="only use responses from the cache, don't make any requests to the API")
+	parser.add_argument("--no-checkpoints",action="store_true",help="don't save pages to checkpoint files for resuming interrupted downloads")
+	parser.add_argument("--incremental",action="store_true",default=incremental_refresh,help="only fetch and extract records changed since the last run, using the record store")
+	parser.add_argument("--record-store",default=record_store_path,metavar="PATH",help="record store file for --incremental (default: %(default)s)")
+	parser.add_argument("--local-queries",action="store_true",default=local_queries,help="answer searches from the record store when an earlier search already holds their records (implies --incremental)")
+	parser.add_argument("--max-concurrent-rows",type=int,default=max_concurrent_rows,help="rows of the input CSV run at the same time (default: %(default)s)")
+	parser.add_argument("--extraction-workers",type=int,default=extraction_workers,help="worker processes for extracting data (default: %(default)s)")
+	parser.add_argument("--requests-per-second",type=float,default=requests_per_second,help="rate limit for requests to the API, 0 for none (default: %(default)s)")
+	parser.add_argument("--report",default=run_report_path,metavar="PATH",help="run report file name, without .json/.csv (default: %(default)s)")
+	parser.add_argument("--no-report",action="store_true",help="don't write the run report")
+	parser.add_argument("--profile",action="store_true",default=profile_run,help="profile the run, saving the results to "+profile_path)
+	parser.add_argument("--debug",action="store_true",default=debug,help="write the records returned by the API to response.json")
+	args=parser.parse_args(argv)
+	
+	api_url=args.api_url
+	response_cache_path=None if args.no_cache else args.cache
+	cache_only=args.cache_only
+	checkpoint_downloads=checkpoint_downloads and not args.no_checkpoints
+	incremental_refresh=args.incremental
+	record_store_path=args.record_store
+	local_queries=args.local_queries
+	max_concurrent_rows=args.max_concurrent_rows
+	extraction_workers=args.extraction_workers
+	requests_per_second=args.requests_per_second
+	run_report_path=None if args.no_report else args.report
+	profile_run=args.profile
+	debug=args.debug
+	
+	if args.params_csv :
+		inputFile=args.params_csv
+	else :
+		## Now take labels from CSV file, input at command line
+		inputFile=input("Enter file path or name for CSV input file (or drag and drop), hit enter for default file: ").strip('"')
+	## If no name given default to original fixed input
+	if not inputFile :
+		inputFile="discovery_api_SearchRecords_input_params.csv"
+	paramsIn=pathlib.Path(inputFile)
 
-		## As we're expecting to make further requests to get the full record set, copy the response out into a clean list
-		myRecords=copy.deepcopy(rjson["records"])
+	## check we've got a valid path, if not raise error and exit script
+	try :
+		paramsIn.resolve(strict=True)
+	except FileNotFoundError:
+		print("Cannot find specified input file, script will exit with error")
+		raise;
 
-		## So we can see progress, print out original value for batchStartMark, the returned value for batchStartMark, and the number of records returned by this request
-		print(myparams["sps.batchStartMark"],rjson["nextBatchMark"],str(len(rjson["records"])))
-		
-		debug = False
-		## Having developed the rest of the script, don't really need the JSON written out, but may be useful for debugging, so keep code
-		if debug :
-			## Open a file to write the json response out into (will automatically be closed once we've processed all requests), reasonably nicely formatted using pprint = pretty print
-			responseout=open("response.json","w",encoding="utf-8")
-			## by default, write out just the records portion included in the returned data. Swap which of the two lines immediately below is commented to write out the whole response
-			# responseout.write(pprint.pformat(rjson))
-			responseout.write(pprint.pformat(myRecords))
-			
-			##Uncomment the following line to also show the output in the command line window
-			# pprint.pprint(rjson)
-			
-		## Keep requesting data until we have retrieved all records, at that point the nextBatchMark is not updated, so the value used for the call will match the returned value
-		while (myparams["sps.batchStartMark"] != rjson["nextBatchMark"] and myparams["sps.batchStartMark"] != "null" ) and (max_records==0 or int(rjson["count"]) < max_records) :
-			## Update the parameter set with the returned value for nextBatchMark so we can get the next portion of data with our next request
-			myparams["sps.batchStartMark"]=rjson["nextBatchMark"]
-			
-			## Make our next GET request
-			r=s.get(url, headers=headers, params=myparams);
-			
-			## Again, decode the JSON returned
-			rjson=r.json()
-			
-			## Add the whole new set of records that have been returned to our master list
-			myRecords.extend(rjson["records"])
-			
-			## so we can see progress, print out original value for batchStartMark, the returned value for batchStartMark, and the number of records returned by this request
-			print(myparams["sps.batchStartMark"],rjson["nextBatchMark"],str(len(rjson["records"])))
-			
-			## by default, write out just the records portion included in the returned data. Swap which of the two lines immediately below is commented to write out the whole response
-			# responseout.write(pprint.pformat(rjson))
-			if debug :
-				responseout.write(pprint.pformat(myRecords))
-				
-				##Uncomment the following line to also show the output in the command line window
-				# pprint.pprint(rjson)
-		if debug :
-			responseout.close()
-		## Now create our equivalent of a spreadsheet, called a DataFrame.  Select just the fields we're interested in: compared to the original analysis we're also keeping
-		## the machine readable versions of the covering date "startDate","endDate","numStartDate","numEndDate" which should make date related questions easier to handle,
-		## and also places is already pulled out as a separate field in the JSON data, so we might as well take it, though the regex will also pull it out of the description separately
-		
-		## First set up various functions that will do the work of applying the regex and splitting out labelled text.
-		def search_for_match(v) :
-			'''Find match for each row (to be saved in temporary column in DataFrame)'''
-			match=desc_fields.search(v["description"])
-			
-			return match
-		
-		def get_labelled_data(v,label_id) :
-			'''Function used to extract the data associated with a given label used in the description field'''
-			# match=desc_fields.search(v["description"])
-			if v["match"] :
-				matchdict=v["match"].groupdict()
-				labelled_data=matchdict[label_id]
-				## if you're not getting expected output, try uncommenting print statements below to see which descriptions are actually matching.
-				if labelled_data :
-					## tidy up a bit, remove any square brackets used to fill out detail to make data more consistent for analysis
-					labelled_data=labelled_data.replace("[","").replace("]","")
-					# print(v["reference"],label_id,labelled_data)
-				else :
-					# print(v["reference"],"no labelled_data found for:",v[label_id])
-					## no action to be taken, just carry on
-					pass;
-			## return statement sets the new column in our DataFrame to the value extracted from the description field.
-			else :
-				print("no match object for",v["reference"],label_id)
-				labelled_data=None
-			return labelled_data;
-
-		def no_extracted_data(v) :
-			'''Check for rows which don't seem to have any extracted data'''
-			no_extracted_data=True
-			for label_id in desc_fields.groupindex.keys() :
-				if v[label_id] :
-					no_extracted_data=False
-			if no_extracted_data :
-				print("no data extracted from description for",v["reference"],v["description"])
-			return no_extracted_data
-
-		def other_possible_labels(v) :
-			'''Look for any other possible labels within the description by searching for additional colons'''
-			## First remove existing labels from a copy of the description
-			desc_without_known_labels=v["description"]
-			other_possible_labels=[]
-			for label in labels :
-				desc_without_known_labels=desc_without_known_labels.replace(label+":","")
-			## Count how many colons remain in the description text
-			max_possible_other_labels=desc_without_known_labels.count(":")
-			if max_possible_other_labels > 0 :
-				start_pos=0
-				## Now for each colon, work back through the string until we find characters that would normally break up the text, eg square brackets or full
-				## stops and return text between that and the colon position as a possible label, and add to list of possible labels
-				for i in range(max_possible_other_labels) :
-					colon_pos=desc_without_known_labels.find(":",start_pos)
-					start_pos=colon_pos+1
-					begin_label_slice=max(desc_without_known_labels.rfind(".",0,colon_pos-1),desc_without_known_labels.rfind("[",0,colon_pos-1))
-					print(str(begin_label_slice),str(colon_pos-1))
-					new_label_candidate=desc_without_known_labels[begin_label_slice:colon_pos].strip("".join((string.whitespace,string.punctuation,string.digits)))
-					other_possible_labels.append(new_label_candidate)
-			## if there's anything in the list of possible labels, return the list, otherwise return None.
-			if len(other_possible_labels) > 0 :
-				print("Additional possible data labels found in",v["reference"],str(other_possible_labels))
-				return other_possible_labels
-			else :
-				return None
-		
-		## Now create the dataframe with the most important columns from the JSON
-		
-		df=pd.DataFrame(data=myRecords,columns=discovery_columns);
-		
-		## Apply data extraction regex to each description in turn, save resulting "match object" to new column
-		if desc_fields :
-			print("Finding regex matches")
-			df["match"]=df.apply(search_for_match,axis=1)
-			## For each label_id, pull out the related data into a new column
-			for label_id in desc_fields.groupindex.keys() :
-				print("label_id:",label_id)
-				df[label_id]=df.apply(get_labelled_data,axis=1,args=(label_id,))
-			## Look for rows that seem to have no data extracted at all.
-			df["no_extracted_data"]=df.apply(no_extracted_data,axis=1)
-			
-			## Match object doesn't give us anything useful to include in overall output so delete the column, keeping everything else in original dataframe.
-			df.drop(labels="match", axis=1, inplace=True)
-		else :
-			print("no desc_fields regex object")#
-			df["no_extracted_data"]=True
-		## check for any other possible labels in text that we didn't include in original list of labels
-		df["other_possible_labels"]=df.apply(other_possible_labels,axis=1)
-		
-		## About to write out file, ensure that parent directories exist (exist=True means the mk_dir won't error if directory already there, parents=True
-		## means all parent directories will also be created if necessary. An error will be raised if there is a file of the same name as a parent directory.
-		outpath.parent.mkdir(exist_ok=True,parents=True)
-		
-		## If output file has already been used, switch file mode to append so we don't overwrite existing data, or to pick an existing writer
-		## if we're using Excel output.  Excel output will be held in memory until script is about to complete. Use text encoding from input parameters.
-		if outpath in output_filepaths :
-			outputmode="a"
-		else :
-			outputmode="w"
-		
-		print("output mode",outputmode)
-		
-		if outpath.suffix.lower() in [".xls",".xlsx"] :
-			## We want an actual Excel file,not CSV.  Pandas docs suggested engine would be found automagically based on extension, but that didn't seem
-			## to work, so explicitly set engine for ourselves.
-			if outpath.suffix == ".xls" :
-				excelEngine="xlwt"
-			else :
-				excelEngine="xlsxwriter"
-			if outputmode == "w" :
-				## create writer object, linked to the current outpath by using dictionary.
-				excelWriters[str(outpath)]=pd.ExcelWriter(outpath,engine=excelEngine)
-				## Define sheet name for this Discovery output either the supplied name or Sheet1, putting it in a list associated with the filepath
-				if sheet_name :
-					excelWriterSheets[str(outpath)]=[sheet_name]
-				else :
-					excelWriterSheets[str(outpath)]=["Sheet1"]
-				## Create Excel output going to the defined writer and sheet
-				df.to_excel(excelWriters[str(outpath)],excelWriterSheets[str(outpath)][0],index=False,encoding=output_encoding)
-			else :
-				## We're adding to existing Excel file (in memory), so add a new sheet to the list for the current outpath, either the supplied name or
-				## just Sheetn+1, where n is the number of sheets already in the list for this outpath
-				if sheet_name :
-					excelWriterSheets[str(outpath)].append(sheet_name)
-				else :
-					excelWriterSheets[str(outpath)].append("Sheet"+str(len(excelWriterSheets[str(outpath)])+1))
-				## Create the Excel sheet on the relevant writer
-				df.to_excel(excelWriters[str(outpath)],excelWriterSheets[str(outpath)][-1],index=False,encoding=output_encoding)
-		else :
-			## Any other extension will be treated as plain CSV (could extend to do different dialects eg TSV or, custome separators etc)
-			df.to_csv(outpath,index=False,mode=outputmode,encoding=output_encoding);
-		
-		## Make sure the outpath is in the set of used filepaths
-		output_filepaths.add(outpath)
+	try :
+		run_params_csv(paramsIn)
+	finally :
+		## Close down any worker processes used for extraction
+		if extraction_pool :
+			extraction_pool.shutdown()
 
-## Before we shut down, write the content of the ExcelWriters out to file.
-for excelWriter in excelWriters :
-	excelWriters[excelWriter].save()
\ No newline at end of file
+## Only run the main part of the script when it's run directly, not when it's imported, in particular when it's imported by the worker processes used
+## for extraction (which happens on Windows, and in the EXE built with PyInstaller, which also needs freeze_support to be called first)
+if __name__ == "__main__" :
+	multiprocessing.freeze_support()
+	main()
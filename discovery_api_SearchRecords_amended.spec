@@ -7,7 +7,7 @@ a = Analysis(['discovery_api_SearchRecords.py'],
              pathex=['C:\\Program Files (x86)\\Windows Kits\\10\\Redist\\ucrt\\DLLs\\x64'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=['requests','requests.adapters','pandas','pathvalidate','xlsxwriter','xlwt','pyarrow','pyarrow.parquet','pyarrow.ipc','psutil'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
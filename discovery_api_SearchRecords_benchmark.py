@@ -0,0 +1,281 @@
+## Benchmarks for discovery_api_SearchRecords.py which run entirely offline, using a local stand-in for the Discovery SearchRecords API endpoint.
+## The stand-in server makes up SC 8 (Ancient Petitions) style records, with descriptions using a realistic mix of labels, and supports deep paging with
+## sps.batchStartMark/nextBatchMark, sps.resultsPageSize and sps.dateFrom/sps.dateTo. It can also add a delay to each response, and fail a share of
+## requests with a 503 error, so that the retry handling is exercised.
+## Benchmarks cover:
+##   paging - requesting all pages of a search through the script's shared transport
+##   extraction - building the DataFrame and extracting the labelled data, with a small and a large set of labels
+##   write - writing the extracted data out as CSV and Excel (xlsx, and xls if asked for)
+## each for a number of record counts (by default 10,000, 100,000 and 1,000,000). Results are printed, and added as a line of JSON to
+## discovery_api_benchmark_results.jsonl, along with the version of the script (from git, if available), so that runs can be compared between versions.
+## The results of each run are compared against the previous run in the results file (or the run with the label given with --compare).
+## Run "python discovery_api_SearchRecords_benchmark.py --help" for the options.
+
+## Python standard libraries used
+import argparse;
+import datetime;
+import gzip;
+import http.server;
+import json;
+import pathlib;
+import platform;
+import random;
+import subprocess;
+import sys;
+import tempfile;
+import threading;
+import time;
+import urllib.parse;
+## The script being benchmarked (its main part only runs when it's run directly, so importing it doesn't prompt for an input file)
+import discovery_api_SearchRecords as dapi;
+
+## Labels used in SC 8 descriptions, in the order they appear
+sc8_labels=["Petitioners","Name(s)","Addressees","Occupation","Nature of request","Nature of endorsement","Places mentioned","People mentioned"]
+## Other labels which turn up in some descriptions, mixed in with the SC 8 labels to make the large label set
+other_labels=["Endorsement","Dating","Seal","Language","Physical description","Former reference","Related material","Note","Script","Condition",
+	"Date of petition","Date of endorsement","Reply","Council","Chancery","Exchequer","Parliament","Witnesses","Sureties","Memoranda",
+	"Enrolment","Warrant","Writ","Inquisition"]
+## Labels in the order they're put into descriptions
+description_labels=sc8_labels[0:4]+other_labels[0:12]+sc8_labels[4:]+other_labels[12:]
+## Label sets used for the extraction benchmark
+label_sets={"small":["Petitioners","Name(s)","Addressees"],"large":description_labels}
+
+words=["the","king","council","petition","abbot","prior","of","and","for","his","lands","manor","rent","wrongs","done","by","sheriff","bailiff",
+	"London","York","Westminster","Bristol","Norwich","merchant","burgesses","commonalty","tenants","chaplain","widow","heirs","grant","pardon",
+	"debt","wool","customs","writ","remedy","restitution","goods","taken","[illegible]","[?king]","c.","1327","Edward","Richard","John","Thomas"]
+places=["London","York","Westminster","Bristol","Norwich","Lincoln","Winchester","Canterbury","Exeter","Chester"]
+
+## Range of years covered by the made up records, which are spread evenly through it in reference order
+first_year=1272
+last_year=1500
+
+def record_year(index,count) :
+	'''Year of the record at the given position among count records'''
+	return first_year+(index*(last_year-first_year+1))//count
+
+def make_text(rng) :
+	'''Some random text for the value of a label'''
+	return " ".join(rng.choice(words) for wordcount in range(rng.randint(2,12)))
+
+def make_record(index,count) :
+	'''Make up the record at the given position among count records, in the shape returned by the SearchRecords endpoint. The same index
+	always gives the same record, so records don't need to be held in memory.'''
+	rng=random.Random(index)
+	year=record_year(index,count)
+	record_places=rng.sample(places,rng.randint(0,3))
+	description_parts=[]
+	## most descriptions have most of the SC 8 labels, and a few of the others, while a few have no labels at all
+	if rng.random() > 0.02 :
+		for label in description_labels :
+			if label in sc8_labels :
+				used=rng.random() < 0.8
+			else :
+				used=rng.random() < 0.08
+			if used :
+				if label == "Places mentioned" and record_places :
+					description_parts.append(f"{label}: {', '.join(record_places)}.")
+				else :
+					description_parts.append(f"{label}: {make_text(rng)}.")
+	else :
+		description_parts.append(make_text(rng).capitalize()+".")
+	return {"id":f"C{9000000+index}","reference":f"SC 8/{index//1000+1}/{index}","coveringDates":str(year),"startDate":f"01/01/{year}","endDate":f"31/12/{year}",
+		"numStartDate":year*10000+101,"numEndDate":year*10000+1231,"description":" ".join(description_parts),"places":record_places,"title":None,
+		"altName":None,"context":"Special Collections - Ancient Petitions","heldBy":["The National Archives, Kew"],"department":"SC","catalogueLevel":7,
+		"closureStatus":"O","closureType":"N","closureCode":"0","openingDate":None,"score":1.0,"source":"100","taxonomies":[],"urlParameters":None}
+
+def first_index_from_year(year,count) :
+	'''Position of the first record with a year of at least the given year (or count if there is none), as records are in year order'''
+	low,high=0,count
+	while low < high :
+		middle=(low+high)//2
+		if record_year(middle,count) < year :
+			low=middle+1
+		else :
+			high=middle
+	return low
+
+class FakeDiscoveryHandler(http.server.BaseHTTPRequestHandler) :
+	'''Answers SearchRecords requests with made up records. Settings are taken from the server: record_count, latency (seconds added to each
+	response) and error_rate (share of requests failed with a 503 error).'''
+	def do_GET(self) :
+		query=urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+		if self.server.latency :
+			time.sleep(self.server.latency)
+		if self.server.error_rate and random.random() < self.server.error_rate :
+			self.send_response(503)
+			self.send_header("Retry-After","0")
+			self.send_header("Content-Length","0")
+			self.end_headers()
+			return
+
+		## the records are in year order, so a date range is a continuous range of positions
+		count=self.server.record_count
+		start,end=0,count
+		if query.get("sps.dateFrom") :
+			start=first_index_from_year(int(query["sps.dateFrom"][0][0:4]),count)
+		if query.get("sps.dateTo") :
+			end=first_index_from_year(int(query["sps.dateTo"][0][0:4])+1,count)
+		end=max(start,end)
+		page_size=min(int(query.get("sps.resultsPageSize",["15"])[0] or 15),1000)
+
+		## the batch marks used here are just the position of the next record, the real API uses opaque strings
+		batch_mark=query.get("sps.batchStartMark",["*"])[0]
+		if batch_mark == "*" :
+			page_start=start
+		else :
+			page_start=int(batch_mark)
+		page_end=min(page_start+page_size,end)
+		records=[make_record(index,count) for index in range(page_start,page_end)]
+		## once all records have been returned nextBatchMark stays the same as the batchStartMark
+		if records :
+			next_batch_mark=str(page_end)
+		else :
+			next_batch_mark=batch_mark
+		body=json.dumps({"records":records,"count":end-start,"nextBatchMark":next_batch_mark}).encode("utf-8")
+
+		self.send_response(200)
+		self.send_header("Content-Type","application/json; charset=utf-8")
+		if "gzip" in self.headers.get("Accept-Encoding","") :
+			body=gzip.compress(body,compresslevel=1)
+			self.send_header("Content-Encoding","gzip")
+		self.send_header("Content-Length",str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self,format,*args) :
+		## don't print a line for every request
+		pass;
+
+def start_fake_server(record_count,latency=0,error_rate=0) :
+	'''Start the stand-in server on a free local port in a background thread, returning the server and the URL for its endpoint'''
+	server=http.server.ThreadingHTTPServer(("127.0.0.1",0),FakeDiscoveryHandler)
+	server.daemon_threads=True
+	server.record_count=record_count
+	server.latency=latency
+	server.error_rate=error_rate
+	threading.Thread(target=server.serve_forever,daemon=True).start()
+	return server, f"http://127.0.0.1:{server.server_address[1]}/API/search/v1/records"
+
+def make_result(benchmark,variant,size,seconds) :
+	'''One benchmark result, with the throughput in records per second'''
+	print(f"{benchmark:10} {variant:8} {size:>9} records {seconds:9.3f} seconds {size/seconds:12.0f} records/second")
+	return {"benchmark":benchmark,"variant":variant,"size":size,"seconds":seconds,"records_per_second":size/seconds}
+
+def benchmark_paging(size,args) :
+	'''Time requesting every page of a search for size records through the script's shared transport'''
+	server,url=start_fake_server(size,args.latency,args.error_rate)
+	try :
+		myparams={"sps.recordSeries":["SC 8"],"sps.catalogueLevels":"Level7","sps.searchQuery":"*","sps.sortByOption":"REFERENCE_ASCENDING",
+			"sps.batchStartMark":"*","sps.resultsPageSize":1000}
+		headers={"Accept": "application/json","Accept-Encoding": "gzip, deflate"}
+		records_retrieved=0
+		start=time.perf_counter()
+		for rjson in dapi.get_record_pages(dapi.transport,url,headers,myparams,stats={},fields=dapi.default_discovery_columns) :
+			records_retrieved+=len(rjson["records"])
+		seconds=time.perf_counter()-start
+	finally :
+		server.shutdown()
+		server.server_close()
+	if records_retrieved != size :
+		raise RuntimeError(f"paging benchmark retrieved {records_retrieved} records rather than {size}")
+	return [make_result("paging",f"{args.latency}s/{args.error_rate}",size,seconds)]
+
+def benchmark_extraction(records,size,args) :
+	'''Time building the DataFrame and extracting the labelled data from the descriptions for the small and large label sets'''
+	results=[]
+	extracted={}
+	for variant, labels in label_sets.items() :
+		desc_fields=dapi.pattern_registry.compile(dapi.build_label_pattern(tuple(labels)))
+		start=time.perf_counter()
+		extracted[variant]=dapi.build_dataframe(records,dapi.default_discovery_columns,desc_fields,labels)
+		results.append(make_result("extraction",variant,size,time.perf_counter()-start))
+	return results, extracted["small"]
+
+def benchmark_write(df,size,args,output_dir) :
+	'''Time writing the extracted data out in each of the output formats asked for'''
+	results=[]
+	for output_format in args.formats :
+		outpath=output_dir / f"benchmark_{size}.{output_format}"
+		start=time.perf_counter()
+		if output_format == "csv" :
+			df.to_csv(outpath,index=False,encoding="utf-8")
+		else :
+			excelWriters={}
+			excelSheet=dapi.ExcelSheetWriter(outpath,"Petitions",excelWriters,{})
+			excelSheet.write(df)
+			dapi.close_excel_workbook(outpath,excelWriters[str(outpath)])
+		results.append(make_result("write",output_format,size,time.perf_counter()-start))
+		outpath.unlink()
+	return results
+
+def get_version() :
+	'''Describe the version of the script being benchmarked, using git if it's available'''
+	try :
+		return subprocess.run(["git","describe","--always","--dirty"],cwd=pathlib.Path(__file__).resolve().parent,capture_output=True,text=True,check=True).stdout.strip()
+	except (OSError,subprocess.CalledProcessError) :
+		return None
+
+def compare_results(run,previous_run) :
+	'''Print the change in time taken for each benchmark since an earlier run'''
+	print("\nCompared with run",previous_run.get("label") or previous_run["started"],"(version",str(previous_run.get("version"))+")")
+	previous_results={(result["benchmark"],result["variant"],result["size"]):result for result in previous_run["results"]}
+	for result in run["results"] :
+		previous_result=previous_results.get((result["benchmark"],result["variant"],result["size"]))
+		if previous_result :
+			change=(result["seconds"]-previous_result["seconds"])/previous_result["seconds"]*100
+			print(f"{result['benchmark']:10} {result['variant']:8} {result['size']:>9} records {previous_result['seconds']:9.3f} -> {result['seconds']:9.3f} seconds ({change:+.1f}%)")
+
+def main() :
+	parser=argparse.ArgumentParser(description="Offline benchmarks for discovery_api_SearchRecords.py, using a local stand-in for the Discovery API")
+	parser.add_argument("--sizes",type=int,nargs="+",default=[10000,100000,1000000],help="numbers of records to benchmark with (default: %(default)s)")
+	parser.add_argument("--benchmarks",nargs="+",choices=["paging","extraction","write"],default=["paging","extraction","write"],help="benchmarks to run (default: all)")
+	parser.add_argument("--formats",nargs="+",choices=["csv","xlsx","xls"],default=["csv","xlsx"],help="output formats for the write benchmark (default: %(default)s)")
+	parser.add_argument("--latency",type=float,default=0,help="seconds added to each response from the stand-in server (default: %(default)s)")
+	parser.add_argument("--error-rate",type=float,default=0,help="share of requests the stand-in server fails with a 503 error, eg 0.05 (default: %(default)s)")
+	parser.add_argument("--requests-per-second",type=float,default=0,help="rate limit for requests, 0 for none (default: %(default)s)")
+	parser.add_argument("--label",help="name for this run in the results file, eg the change being tested")
+	parser.add_argument("--compare",help="compare against the last run with this label, rather than the previous run")
+	parser.add_argument("--results-file",default="discovery_api_benchmark_results.jsonl",help="file the results are added to (default: %(default)s)")
+	args=parser.parse_args()
+
+	## no caching, checkpoints, rate limiting or waiting between retries, so the benchmarks measure the script itself
+	dapi.response_cache=None
+	dapi.requests_per_second=args.requests_per_second
+	dapi.retry_backoff=0
+	dapi.transport=dapi.DiscoveryTransport()
+
+	run={"label":args.label,"version":get_version(),"started":datetime.datetime.now().isoformat(timespec="seconds"),"python":sys.version.split()[0],
+		"platform":platform.platform(),"args":vars(args),"results":[]}
+	with tempfile.TemporaryDirectory() as output_dir :
+		for size in args.sizes :
+			if "paging" in args.benchmarks :
+				run["results"].extend(benchmark_paging(size,args))
+			if "extraction" in args.benchmarks or "write" in args.benchmarks :
+				records=[{column:record[column] for column in dapi.default_discovery_columns} for record in (make_record(index,size) for index in range(size))]
+				extraction_results, df=benchmark_extraction(records,size,args)
+				del records
+				if "extraction" in args.benchmarks :
+					run["results"].extend(extraction_results)
+				if "write" in args.benchmarks :
+					run["results"].extend(benchmark_write(df,size,args,pathlib.Path(output_dir)))
+				del df
+	if dapi.extraction_pool :
+		dapi.extraction_pool.shutdown()
+
+	## compare with the earlier run, then add this run to the results file
+	resultsPath=pathlib.Path(args.results_file)
+	previous_run=None
+	if resultsPath.exists() :
+		with open(resultsPath,mode="r",encoding="utf-8") as resultsIn :
+			for line in resultsIn :
+				earlier_run=json.loads(line)
+				if args.compare is None or earlier_run.get("label") == args.compare :
+					previous_run=earlier_run
+	if previous_run :
+		compare_results(run,previous_run)
+	with open(resultsPath,mode="a",encoding="utf-8") as resultsOut :
+		resultsOut.write(json.dumps(run)+"\n")
+	print("\nResults added to",resultsPath)
+
+if __name__ == "__main__" :
+	main()